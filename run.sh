@@ -1,7 +1,8 @@
 comment=$1
 threshold=$2
 
-nohup bash run_4.sh ${comment} ${threshold} &
-nohup bash run_5.sh ${comment} ${threshold} &
-nohup bash run_6.sh ${comment} ${threshold} &
-nohup bash run_7.sh ${comment} ${threshold} &
+python3 src/sweep.py /data/office -d Office31 --list_dir data/office \
+    --pairs amazon:webcam webcam:dslr amazon:dslr webcam:amazon dslr:amazon dslr:webcam \
+    --thresholds ${threshold} --source_thresholds 0.85 --seeds 2021 \
+    --devices 4 5 6 7 --comment ${comment} \
+    -- --n_share 10 --n_source_private 10 --n_total 31 -b 16 -i 500 --epochs 20
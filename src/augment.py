@@ -0,0 +1,268 @@
+import math
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+
+# batched counterparts of `train_transform1` .. `train_transform5` in datasets.py, applied after `Resize(256)`
+ESEM_VIEWS = [
+    dict(affine=(30, 0.2), crop='center', grayscale=0.5),
+    dict(perspective=True, crop='top_left', color_jitter=True),
+    dict(affine=(30, 0.2), crop='top_right', color_jitter=True),
+    dict(affine=(10, 0.1), perspective=True, crop='bottom_left'),
+    dict(perspective=True, crop='bottom_right', grayscale=0.5),
+]
+
+
+def collate_padded(batch: Sequence[Tuple[torch.Tensor, int]]):
+    """Collates uint8 images of different sizes into one zero padded batch.
+
+    Returns ((images, sizes), labels), where images are aligned to the top left corner
+    and `sizes` holds the (height, width) of each image.
+    """
+    images, labels = zip(*batch)
+    height = max(img.size(1) for img in images)
+    width = max(img.size(2) for img in images)
+    padded = torch.zeros((len(images), images[0].size(0), height, width), dtype=torch.uint8)
+    for i, img in enumerate(images):
+        padded[i, :, :img.size(1), :img.size(2)] = img
+    sizes = torch.tensor([[img.size(1), img.size(2)] for img in images])
+    return (padded, sizes), torch.tensor(labels)
+
+
+def replicate_edges(images: torch.Tensor, sizes: torch.Tensor) -> torch.Tensor:
+    """Replaces the zero padding of a batch from :func:`collate_padded` with the last row and column of each image"""
+    b, c, height, width = images.shape
+    rows = torch.min(torch.arange(height, device=images.device).view(1, -1), sizes[:, :1] - 1)
+    cols = torch.min(torch.arange(width, device=images.device).view(1, -1), sizes[:, 1:] - 1)
+    images = images.gather(2, rows.view(b, 1, height, 1).expand(b, c, height, width))
+    return images.gather(3, cols.view(b, 1, 1, width).expand(b, c, height, width))
+
+
+def uniform(low, high, shape: Tuple[int, ...], device) -> torch.Tensor:
+    return torch.rand(shape, device=device) * (high - low) + low
+
+
+def affine_matrices(w: torch.Tensor, h: torch.Tensor, degrees: float, shear: float,
+                    translate: Optional[float] = 0.1, scale: Optional[Tuple[float, float]] = (0.9, 1.1)):
+    """Random inverse affine matrices of ``RandomAffine``, mapping output pixel coordinates to input ones"""
+    b, device = w.size(0), w.device
+    rot = torch.deg2rad(uniform(-degrees, degrees, (b,), device))
+    sx = torch.deg2rad(uniform(-shear, shear, (b,), device))
+    tx = torch.round(uniform(-translate, translate, (b,), device) * w)
+    ty = torch.round(uniform(-translate, translate, (b,), device) * h)
+    s = uniform(scale[0], scale[1], (b,), device)
+    cx, cy = w * 0.5, h * 0.5
+
+    # the same inverse matrix as torchvision's `_get_inverse_affine_matrix` without vertical shear
+    a = torch.cos(rot)
+    bb = -torch.cos(rot) * torch.tan(sx) - torch.sin(rot)
+    c = torch.sin(rot)
+    d = -torch.sin(rot) * torch.tan(sx) + torch.cos(rot)
+    m0, m1, m3, m4 = d / s, -bb / s, -c / s, a / s
+    m2 = m0 * (-cx - tx) + m1 * (-cy - ty) + cx
+    m5 = m3 * (-cx - tx) + m4 * (-cy - ty) + cy
+    zeros, ones = torch.zeros_like(w), torch.ones_like(w)
+    return torch.stack([m0, m1, m2, m3, m4, m5, zeros, zeros, ones], dim=1).view(b, 3, 3)
+
+
+def perspective_matrices(w: torch.Tensor, h: torch.Tensor, distortion: Optional[float] = 0.5,
+                         p: Optional[float] = 0.5):
+    """Random homographies of ``RandomPerspective``, mapping output pixel coordinates to input ones.
+    Samples that are not distorted, with probability 1 - `p`, get the identity."""
+    b, device = w.size(0), w.device
+    dx, dy = distortion * w / 2, distortion * h / 2
+    start = torch.stack([torch.zeros_like(w), torch.zeros_like(h), w - 1, torch.zeros_like(h),
+                         w - 1, h - 1, torch.zeros_like(w), h - 1], dim=1).view(b, 4, 2)
+    jitter = torch.rand((b, 4, 2), device=device) * torch.stack([dx, dy], dim=1).unsqueeze(1)
+    sign = torch.tensor([[1., 1.], [-1., 1.], [-1., -1.], [1., -1.]], device=device)
+    end = start + sign * jitter
+
+    # solve for the coefficients mapping the end points back to the start points
+    x, y = end[..., 0], end[..., 1]
+    u, v = start[..., 0], start[..., 1]
+    zeros, ones = torch.zeros_like(x), torch.ones_like(x)
+    rows_u = torch.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], dim=-1)
+    rows_v = torch.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], dim=-1)
+    a = torch.cat([rows_u, rows_v], dim=1)
+    coeffs = torch.linalg.solve(a, torch.cat([u, v], dim=1))
+    matrices = torch.cat([coeffs, torch.ones((b, 1), device=device)], dim=1).view(b, 3, 3)
+
+    applied = torch.rand(b, device=device) < p
+    identity = torch.eye(3, device=device).expand(b, 3, 3)
+    return torch.where(applied.view(b, 1, 1), matrices, identity)
+
+
+def rgb_to_grayscale(img: torch.Tensor) -> torch.Tensor:
+    return (0.2989 * img[:, 0] + 0.587 * img[:, 1] + 0.114 * img[:, 2]).unsqueeze(1)
+
+
+def blend(img1: torch.Tensor, img2: torch.Tensor, ratio: torch.Tensor) -> torch.Tensor:
+    ratio = ratio.view(-1, 1, 1, 1)
+    return (ratio * img1 + (1 - ratio) * img2).clamp_(0, 1)
+
+
+def rgb_to_hsv(img: torch.Tensor) -> torch.Tensor:
+    r, g, b = img.unbind(1)
+    maxc, _ = img.max(dim=1)
+    minc, _ = img.min(dim=1)
+    cr = maxc - minc
+    s = cr / torch.where(maxc == 0, torch.ones_like(maxc), maxc)
+    cr_divisor = torch.where(maxc == minc, torch.ones_like(cr), cr)
+    rc, gc, bc = (maxc - r) / cr_divisor, (maxc - g) / cr_divisor, (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def hsv_to_rgb(img: torch.Tensor) -> torch.Tensor:
+    h, s, v = img.unbind(1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(torch.int64) % 6
+    p = (v * (1.0 - s)).clamp(0, 1)
+    q = (v * (1.0 - s * f)).clamp(0, 1)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0, 1)
+    mask = i.unsqueeze(1) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=1)
+    a2 = torch.stack((t, v, v, q, p, p), dim=1)
+    a3 = torch.stack((p, p, t, v, v, q), dim=1)
+    a4 = torch.stack((a1, a2, a3), dim=1)
+    return torch.einsum("...ijk, ...xijk -> ...xjk", mask.to(img.dtype), a4)
+
+
+def random_color_jitter(img: torch.Tensor, strength: Optional[float] = 0.2) -> torch.Tensor:
+    """``ColorJitter(strength, strength, strength, strength)`` with per-sample factors.
+    The order of the four adjustments is drawn once per batch."""
+    b, device = img.size(0), img.device
+    for fn in torch.randperm(4).tolist():
+        if fn == 0:
+            img = blend(img, torch.zeros_like(img), uniform(1 - strength, 1 + strength, (b,), device))
+        elif fn == 1:
+            mean = rgb_to_grayscale(img).mean(dim=(1, 2, 3), keepdim=True)
+            img = blend(img, mean.expand_as(img), uniform(1 - strength, 1 + strength, (b,), device))
+        elif fn == 2:
+            img = blend(img, rgb_to_grayscale(img).expand_as(img), uniform(1 - strength, 1 + strength, (b,), device))
+        else:
+            hsv = rgb_to_hsv(img)
+            hue = torch.remainder(hsv[:, 0] + uniform(-strength, strength, (b,), device).view(b, 1, 1), 1.0)
+            img = hsv_to_rgb(torch.stack((hue, hsv[:, 1], hsv[:, 2]), dim=1))
+    return img
+
+
+class BatchAugmenter:
+    """Produces the ensemble views of a batch of uint8 images with batched tensor operations.
+
+    All geometric steps of a view (horizontal flip, affine warp, perspective warp and the crop) are composed
+    into one sampling grid per image, so only the 224x224 crop that the view keeps is ever computed.
+    Pixels that a warp moves in from outside the image get the fill value of that warp, as in torchvision.
+
+    Parameters:
+        - **views** (list): View specifications, see ``ESEM_VIEWS``. Default: the five ensemble views
+        - **size** (int, optional): Output crop size. Default: 224
+    """
+
+    def __init__(self, views: Optional[List[dict]] = None, size: Optional[int] = 224):
+        self.views = ESEM_VIEWS if views is None else views
+        self.size = size
+
+    def __call__(self, images: torch.Tensor, sizes: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Parameters:
+            - **images** (tensor): Zero padded uint8 images of shape :math:`(B, 3, H, W)`
+            - **sizes** (tensor): (height, width) of each image, of shape :math:`(B, 2)`
+            - **return** (list): One normalized float view of shape :math:`(B, 3, size, size)` per view spec
+        """
+        sizes = sizes.to(images.device)
+        src = replicate_edges(images, sizes).float().div_(255)
+        return [self.view(src, sizes, **view) for view in self.views]
+
+    def view(self, src: torch.Tensor, sizes: torch.Tensor, crop: str, affine: Optional[Tuple[float, float]] = None,
+             perspective: Optional[bool] = False, color_jitter: Optional[bool] = False,
+             grayscale: Optional[float] = 0.) -> torch.Tensor:
+        b, _, height, width = src.shape
+        device = src.device
+        h, w = sizes[:, 0].float(), sizes[:, 1].float()
+
+        # pixel centers of the crop, in the coordinates of the warped image
+        offset_x = {'center': torch.round((w - self.size) / 2), 'top_left': torch.zeros_like(w),
+                    'top_right': w - self.size, 'bottom_left': torch.zeros_like(w),
+                    'bottom_right': w - self.size}[crop]
+        offset_y = {'center': torch.round((h - self.size) / 2), 'top_left': torch.zeros_like(h),
+                    'top_right': torch.zeros_like(h), 'bottom_left': h - self.size,
+                    'bottom_right': h - self.size}[crop]
+        centers = torch.arange(self.size, device=device, dtype=torch.float32) + 0.5
+        x = centers.repeat(self.size).view(1, -1) + offset_x.view(b, 1)
+        y = centers.repeat_interleave(self.size).view(1, -1) + offset_y.view(b, 1)
+
+        # undo the warps from the last applied one, recording the fill of the first warp leaving the image
+        stages = []
+        if perspective:
+            stages.append((perspective_matrices(w, h), 0.))
+        if affine is not None:
+            stages.append((affine_matrices(w, h, *affine), 1.))
+        filled = torch.zeros_like(x, dtype=torch.bool)
+        fill = torch.zeros_like(x)
+        for matrix, fill_value in stages:
+            points = torch.stack([x, y, torch.ones_like(x)], dim=1)
+            points = torch.bmm(matrix, points)
+            x, y = points[:, 0] / points[:, 2], points[:, 1] / points[:, 2]
+            outside = ~filled & ((x < 0) | (x > w.view(b, 1)) | (y < 0) | (y > h.view(b, 1)))
+            fill = torch.where(outside, torch.full_like(fill, fill_value), fill)
+            filled |= outside
+
+        flip = torch.rand((b, 1), device=device) < 0.5
+        x = torch.where(flip, w.view(b, 1) - x, x)
+
+        # sample inside each image's own border; with the replicated padding, interpolation taps beyond it
+        # read the edge pixels as torchvision does, instead of the zeros padding smaller images
+        x = torch.max(torch.min(x, w.view(b, 1) - 0.5), torch.full_like(x, 0.5))
+        y = torch.max(torch.min(y, h.view(b, 1) - 0.5), torch.full_like(y, 0.5))
+        grid = torch.stack([x / width * 2 - 1, y / height * 2 - 1], dim=-1).view(b, self.size, self.size, 2)
+        out = F.grid_sample(src, grid, mode='bicubic' if affine is not None else 'bilinear',
+                            padding_mode='border', align_corners=False).clamp_(0, 1)
+        out = torch.where(filled.view(b, 1, self.size, self.size), fill.view(b, 1, self.size, self.size), out)
+
+        if color_jitter:
+            out = random_color_jitter(out)
+        if grayscale > 0:
+            gray = torch.rand((b, 1, 1, 1), device=device) < grayscale
+            out = torch.where(gray, rgb_to_grayscale(out).expand_as(out), out)
+
+        mean = torch.tensor(MEAN, device=device).view(1, 3, 1, 1)
+        std = torch.tensor(STD, device=device).view(1, 3, 1, 1)
+        return (out - mean) / std
+
+
+class AugmentedDataIterator:
+    """Wraps a :class:`ForeverDataIterator` over padded uint8 batches and returns ``(views, labels)``
+    like the iterator over a ``MultiViewImageList``"""
+
+    def __init__(self, data_iter, augmenter: BatchAugmenter, device=None):
+        self.data_iter = data_iter
+        self.augmenter = augmenter
+        self.device = device
+
+    @property
+    def data_loader(self):
+        return self.data_iter.data_loader
+
+    def augment(self, batch):
+        """Turns one collated batch ((images, sizes), labels) into (views, labels)"""
+        (images, sizes), labels = batch
+        if self.device is not None:
+            images = images.to(self.device, non_blocking=True)
+        with torch.no_grad():
+            views = self.augmenter(images, sizes)
+        return views, labels
+
+    def __next__(self):
+        return self.augment(next(self.data_iter))
+
+    def __len__(self):
+        return len(self.data_iter)
@@ -1,24 +1,134 @@
+import fcntl
+import hashlib
 import os
 from typing import Optional, Callable, Tuple, Any, List
+import numpy as np
+import torch
 import torchvision.datasets as datasets
 from torchvision.datasets.folder import default_loader
 from torchvision.transforms.transforms import *
 from PIL import Image
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
+from augment import AugmentedDataIterator, BatchAugmenter, collate_padded
+from distributed import is_distributed
 from lib import ForeverDataIterator
+from shards import ShardReader
+
+_data_lists = {}
+
+
+class DataList:
+    """A compact sequence of (image path, class_index) pairs backed by numpy arrays.
+
+    Paths are stored as one UTF-8 buffer with offsets, so data lists of any size are cheap to share
+    between datasets and data loading workers.
+
+    Parameters:
+        - **root** (str): Root directory that relative paths are joined with
+        - **buffer** (np.ndarray): Concatenated encoded paths of the whole list file
+        - **offsets** (np.ndarray): Start of each path in `buffer`, followed by the end of the last one
+        - **labels** (np.ndarray): Class index of each path
+        - **indices** (np.ndarray, optional): Positions of the list file selected by this data list. Default: all
+    """
+
+    def __init__(self, root: str, buffer: np.ndarray, offsets: np.ndarray, labels: np.ndarray,
+                 indices: Optional[np.ndarray] = None):
+        self.root = root
+        self.buffer = buffer
+        self.offsets = offsets
+        self.labels = labels
+        self.indices = np.arange(len(labels)) if indices is None else indices
+
+    def __getitem__(self, index: int) -> Tuple[str, int]:
+        i = self.indices[index]
+        path = self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode()
+        if not os.path.isabs(path):
+            path = os.path.join(self.root, path)
+        return path, int(self.labels[i])
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def filter(self, classes: list) -> 'DataList':
+        """The data list restricted to samples of `classes`"""
+        mask = np.isin(self.labels[self.indices], classes)
+        return DataList(self.root, self.buffer, self.offsets, self.labels, self.indices[mask])
+
+
+def load_data_list(file_name: str, root: str, cache_dir: Optional[str] = None) -> DataList:
+    """Parses a data list file once per process, and with a `cache_dir`, where parsed lists are stored
+    by the hash of the list file, once per file content across processes"""
+    stat = os.stat(file_name)
+    key = (os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size)
+    if key not in _data_lists:
+        _data_lists[key] = _load_data_list_arrays(file_name, cache_dir)
+    buffer, offsets, labels = _data_lists[key]
+    return DataList(root, buffer, offsets, labels)
+
+
+def _load_data_list_arrays(file_name: str, cache_dir: Optional[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    with open(file_name, "rb") as f:
+        content = f.read()
+    if cache_dir is not None:
+        digest = hashlib.sha1(content).hexdigest()
+        cache_file = os.path.join(cache_dir, digest + '.npz')
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as arrays:
+                return arrays['buffer'], arrays['offsets'], arrays['labels']
+
+    paths, labels = [], []
+    for line in content.decode().splitlines():
+        if not line.strip():
+            continue
+        # lines of unlabeled lists only hold the path, their label is -1
+        path, *target = line.split()
+        paths.append(path.encode())
+        labels.append(int(target[0]) if target else -1)
+    buffer = np.frombuffer(b''.join(paths), dtype=np.uint8)
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(path) for path in paths])
+    labels = np.array(labels, dtype=np.int64)
+
+    # the disk cache is best effort, e.g. the cache directory may be read-only
+    if cache_dir is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = os.path.join(cache_dir, '{}.{}.tmp.npz'.format(digest, os.getpid()))
+            np.savez(tmp_file, buffer=buffer, offsets=offsets, labels=labels)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+    return buffer, offsets, labels
 
 
 class ImageList(datasets.VisionDataset):
+    """A dataset of the images in a data list file.
 
-    def __init__(self, root: str, num_class: int, data_list_file: str, filter_class: list,
-                 transform: Optional[Callable] = None, target_transform: Optional[Callable] = None):
+    Parameters:
+        - **filter_class** (list): Classes whose samples are kept, or None to keep all samples, \
+            including the unlabeled ones (label -1) of data lists holding only image paths.
+        - **shard_dir** (str, optional): If given, images are read from the shards packed from the data list \
+            by ``shards.py`` instead of from individual files.
+        - **list_cache_dir** (str, optional): If given, the parsed data list is cached in this directory, \
+            see :func:`load_data_list`.
+    """
+
+    def __init__(self, root: str, num_class: int, data_list_file: str, filter_class: Optional[list],
+                 transform: Optional[Callable] = None, target_transform: Optional[Callable] = None,
+                 shard_dir: Optional[str] = None, list_cache_dir: Optional[str] = None):
         super().__init__(root, transform=transform, target_transform=target_transform)
+        self.list_cache_dir = list_cache_dir
         self.data = self.parse_data_file(data_list_file, filter_class)
         self.num_class = num_class
         # self.class_to_idx = {cls: idx
         #                      for idx, clss in enumerate(self.classes)
         #                      for cls in clss}
-        self.loader = default_loader
+        self.loader = default_loader if shard_dir is None else ShardReader(shard_dir)
 
     def __getitem__(self, index: int, ) -> Tuple[Any, int]:
         """
@@ -37,23 +147,15 @@ class ImageList(datasets.VisionDataset):
     def __len__(self) -> int:
         return len(self.data)
 
-    def parse_data_file(self, file_name: str, filter_class: list) -> List[Tuple[str, int]]:
+    def parse_data_file(self, file_name: str, filter_class: list) -> DataList:
         """Parse file to data list
 
         Parameters:
             - **file_name** (str): The path of data file
-            - **return** (list): List of (image path, class_index) tuples
+            - **return** (DataList): Sequence of (image path, class_index) tuples
         """
-        with open(file_name, "r") as f:
-            data_list = []
-            for line in f.readlines():
-                path, target = line.split()
-                if not os.path.isabs(path):
-                    path = os.path.join(self.root, path)
-                target = int(target)
-                if target in filter_class:
-                    data_list.append((path, target))
-        return data_list
+        data_list = load_data_list(file_name, self.root, self.list_cache_dir)
+        return data_list if filter_class is None else data_list.filter(filter_class)
 
     @property
     def num_classes(self) -> int:
@@ -61,6 +163,107 @@ class ImageList(datasets.VisionDataset):
         return self.num_class
 
 
+class MultiViewImageList(ImageList):
+    """Image list that decodes each image once and produces several augmented views of it.
+
+    Parameters:
+        - **view_transforms** (list): One transform per view, each takes the shared image and returns a view
+        - **pre_transform** (callable, optional): A deterministic transform applied once per sample \
+            before the views are produced. E.g, ``transforms.Resize``.
+    """
+
+    def __init__(self, root: str, num_class: int, data_list_file: str, filter_class: list,
+                 view_transforms: List[Callable], pre_transform: Optional[Callable] = None,
+                 target_transform: Optional[Callable] = None, shard_dir: Optional[str] = None,
+                 list_cache_dir: Optional[str] = None):
+        super().__init__(root, num_class, data_list_file, filter_class, target_transform=target_transform,
+                         shard_dir=shard_dir, list_cache_dir=list_cache_dir)
+        self.view_transforms = view_transforms
+        self.pre_transform = pre_transform
+
+    def __getitem__(self, index: int) -> Tuple[List[Any], int]:
+        """
+        Parameters:
+            - **index** (int): Index
+            - **return** (tuple): (views, target) where views is a list with one image per view transform.
+        """
+        path, target = self.data[index]
+        img = self.loader(path)
+        if self.pre_transform is not None:
+            img = self.pre_transform(img)
+        views = [transform(img) for transform in self.view_transforms]
+        if self.target_transform is not None and target is not None:
+            target = self.target_transform(target)
+        return views, target
+
+
+class DecodedImageCache(Dataset):
+    """Caches the uint8 images produced by the deterministic transform of an image list in a memory-mapped file.
+
+    The first time a sample is requested it is loaded and transformed by `dataset`, afterwards it is served
+    from the cache without decoding. The cache file is named after the content of the data list, so
+    later runs over the same list reuse it.
+
+    Parameters:
+        - **dataset** (ImageList): Image list whose transform returns uint8 tensors of shape `shape`, \
+            e.g. ``Compose([ResizeImage(256), CenterCrop(224), PILToTensor()])``
+        - **cache_dir** (str): Directory of the cache files
+        - **shape** (tuple, optional): Shape of each image. Default: (3, 224, 224)
+    """
+
+    def __init__(self, dataset: ImageList, cache_dir: str, shape: Optional[Tuple[int, ...]] = (3, 224, 224)):
+        self.dataset = dataset
+        self.shape = tuple(shape)
+        # the images depend on the resolved paths, the root and the transform producing them
+        key = '\n'.join('{} {}'.format(path, target) for path, target in dataset.data)
+        key += '\n{}\n{}\n{}'.format(os.path.abspath(dataset.root), repr(dataset.transform), self.shape)
+        name = 'decoded_{}'.format(hashlib.sha1(key.encode()).hexdigest()[:16])
+        os.makedirs(cache_dir, exist_ok=True)
+        self.images_file = os.path.join(cache_dir, name + '.npy')
+        self.filled_file = os.path.join(cache_dir, name + '.filled.npy')
+
+        # concurrent runs over the same list (sweep slots, distributed processes) create the files only once;
+        # they are written under temporary names and renamed, the flags last, so they are never seen half made
+        with open(os.path.join(cache_dir, name + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not (os.path.exists(self.images_file) and os.path.exists(self.filled_file)):
+                suffix = '.{}.tmp.npy'.format(os.getpid())
+                np.lib.format.open_memmap(self.images_file + suffix, mode='w+', dtype=np.uint8,
+                                          shape=(len(dataset),) + self.shape)
+                np.lib.format.open_memmap(self.filled_file + suffix, mode='w+', dtype=np.bool_,
+                                          shape=(len(dataset),))
+                os.replace(self.images_file + suffix, self.images_file)
+                os.replace(self.filled_file + suffix, self.filled_file)
+        self._images = None
+        self._filled = None
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, int]:
+        if self._images is None:
+            # opened lazily, so that every data loading worker maps the files itself
+            self._images = np.load(self.images_file, mmap_mode='r+')
+            self._filled = np.load(self.filled_file, mmap_mode='r+')
+        if not self._filled[index]:
+            img, target = self.dataset[index]
+            self._images[index] = img.numpy()
+            self._filled[index] = True
+            return img, target
+
+        img = torch.from_numpy(np.array(self._images[index]))
+        target = self.dataset.data[index][1]
+        if self.dataset.target_transform is not None:
+            target = self.dataset.target_transform(target)
+        return img, target
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        state['_filled'] = None
+        return state
+
+
 class Office31(ImageList):
     """Office31 Dataset.
 
@@ -108,8 +311,10 @@ class Office31(ImageList):
         super(Office31, self).__init__(root, len(filter_class), data_list_file, filter_class, **kwargs)
 
 
+# the ensemble views share one decode and resize per sample, see MultiViewImageList
+esem_pre_transform = Resize(256)
+
 train_transform1 = Compose([
-    Resize(256),
     RandomHorizontalFlip(),
     RandomAffine(degrees=30, translate=(0.1, 0.1), scale=(0.9, 1.1), shear=0.2, interpolation=InterpolationMode.BICUBIC,
                  fill=(255, 255, 255)),
@@ -121,7 +326,6 @@ train_transform1 = Compose([
 ])
 
 train_transform2 = Compose([
-    Resize(256),
     RandomHorizontalFlip(),
     RandomPerspective(),
     FiveCrop(224),
@@ -133,7 +337,6 @@ train_transform2 = Compose([
 ])
 
 train_transform3 = Compose([
-    Resize(256),
     RandomHorizontalFlip(),
     RandomAffine(degrees=30, translate=(0.1, 0.1), scale=(0.9, 1.1), shear=0.2, interpolation=InterpolationMode.BICUBIC,
                  fill=(255, 255, 255)),
@@ -146,7 +349,6 @@ train_transform3 = Compose([
 ])
 
 train_transform4 = Compose([
-    Resize(256),
     RandomHorizontalFlip(),
     RandomAffine(degrees=10, translate=(0.1, 0.1), scale=(0.9, 1.1), shear=0.1, interpolation=InterpolationMode.BICUBIC,
                  fill=(255, 255, 255)),
@@ -159,7 +361,6 @@ train_transform4 = Compose([
 ])
 
 train_transform5 = Compose([
-    Resize(256),
     RandomHorizontalFlip(),
     RandomPerspective(),
     FiveCrop(224),
@@ -170,33 +371,43 @@ train_transform5 = Compose([
               std=[0.229, 0.224, 0.225]),
 ])
 
+esem_transforms = [train_transform1, train_transform2, train_transform3, train_transform4, train_transform5]
+
+
+def loader_kwargs(args) -> dict:
+    """DataLoader options shared by all loaders: workers, pinned memory, persistent workers and prefetch depth"""
+    kwargs = {'num_workers': args.workers, 'pin_memory': args.pin_memory and torch.cuda.is_available()}
+    if args.workers > 0:
+        kwargs.update(persistent_workers=args.persistent_workers, prefetch_factor=args.prefetch_factor)
+    return kwargs
+
+
+def sampler_kwargs(dataset: Dataset, shuffle: bool) -> dict:
+    """DataLoader `shuffle` or `sampler` option, sharding `dataset` across the processes of a distributed run"""
+    if is_distributed():
+        return {'sampler': DistributedSampler(dataset, shuffle=shuffle)}
+    return {'shuffle': shuffle}
+
+
+def esem_dataloader(args, filter_class, device=None):
+    if args.batch_augment:
+        # workers only decode and resize, the views are produced batched on `device`
+        train_source_dataset = ImageList(root=args.root, num_class=len(filter_class), data_list_file=args.source,
+                                         filter_class=filter_class,
+                                         transform=Compose([esem_pre_transform, PILToTensor()]),
+                                         shard_dir=args.source_shards, list_cache_dir=args.list_cache_dir)
+        esem_loader = DataLoader(train_source_dataset, batch_size=args.batch_size, drop_last=True,
+                                 collate_fn=collate_padded, **sampler_kwargs(train_source_dataset, True),
+                                 **loader_kwargs(args))
+        return AugmentedDataIterator(ForeverDataIterator(esem_loader, device, args.prefetch), BatchAugmenter(),
+                                     device)
+
+    train_source_dataset = MultiViewImageList(root=args.root, num_class=len(filter_class),
+                                              data_list_file=args.source, filter_class=filter_class,
+                                              view_transforms=esem_transforms, pre_transform=esem_pre_transform,
+                                              shard_dir=args.source_shards, list_cache_dir=args.list_cache_dir)
+    esem_loader = DataLoader(train_source_dataset, batch_size=args.batch_size, drop_last=True,
+                             **sampler_kwargs(train_source_dataset, True), **loader_kwargs(args))
+    esem_iter = ForeverDataIterator(esem_loader, device, args.prefetch)
 
-def esem_dataloader(args, filter_class):
-    train_source_dataset1 = ImageList(root=args.root, num_class=len(filter_class), data_list_file=args.source,
-                                      filter_class=filter_class, transform=train_transform1)
-    esem_loader1 = DataLoader(train_source_dataset1, batch_size=args.batch_size,
-                              shuffle=True, num_workers=args.workers, drop_last=True)
-    train_source_dataset2 = ImageList(root=args.root, num_class=len(filter_class), data_list_file=args.source,
-                                      filter_class=filter_class, transform=train_transform2)
-    esem_loader2 = DataLoader(train_source_dataset2, batch_size=args.batch_size,
-                              shuffle=True, num_workers=args.workers, drop_last=True)
-    train_source_dataset3 = ImageList(root=args.root, num_class=len(filter_class), data_list_file=args.source,
-                                      filter_class=filter_class, transform=train_transform3)
-    esem_loader3 = DataLoader(train_source_dataset3, batch_size=args.batch_size,
-                              shuffle=True, num_workers=args.workers, drop_last=True)
-    train_source_dataset4 = ImageList(root=args.root, num_class=len(filter_class), data_list_file=args.source,
-                                      filter_class=filter_class, transform=train_transform4)
-    esem_loader4 = DataLoader(train_source_dataset4, batch_size=args.batch_size,
-                              shuffle=True, num_workers=args.workers, drop_last=True)
-    train_source_dataset5 = ImageList(root=args.root, num_class=len(filter_class), data_list_file=args.source,
-                                      filter_class=filter_class, transform=train_transform5)
-    esem_loader5 = DataLoader(train_source_dataset5, batch_size=args.batch_size,
-                              shuffle=True, num_workers=args.workers, drop_last=True)
-
-    esem_iter1 = ForeverDataIterator(esem_loader1)
-    esem_iter2 = ForeverDataIterator(esem_loader2)
-    esem_iter3 = ForeverDataIterator(esem_loader3)
-    esem_iter4 = ForeverDataIterator(esem_loader4)
-    esem_iter5 = ForeverDataIterator(esem_loader5)
-
-    return esem_iter1, esem_iter2, esem_iter3, esem_iter4, esem_iter5
\ No newline at end of file
+    return esem_iter
@@ -0,0 +1,115 @@
+import builtins
+import os
+from typing import Optional
+
+import torch
+import torch.distributed as dist
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(backend: Optional[str] = 'gloo', init_method: Optional[str] = 'env://') -> torch.device:
+    """Joins the process group described by the environment variables of ``torchrun``
+    (``RANK``, ``WORLD_SIZE``, ``LOCAL_RANK``, ``MASTER_ADDR``, ``MASTER_PORT``) and returns the device
+    of this process. Without them, or with a world size of 1, nothing is initialized.
+
+    Only the main process prints, the others are silenced.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        dist.init_process_group(backend=backend, init_method=init_method)
+        if not is_main_process():
+            builtins.print = lambda *args, **kwargs: None
+
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    torch.cuda.set_device(local_rank)
+    return torch.device('cuda', local_rank)
+
+
+def _communicated(tensor: torch.Tensor) -> torch.Tensor:
+    # gloo only implements some collectives for CUDA tensors, so everything is exchanged on the CPU
+    return tensor.cpu() if dist.get_backend() == 'gloo' else tensor
+
+
+def broadcast(tensor: torch.Tensor, src: Optional[int] = 0) -> torch.Tensor:
+    """Returns `tensor` of process `src`, on every process"""
+    if not is_distributed():
+        return tensor
+    buffer = _communicated(tensor).clone()
+    dist.broadcast(buffer, src)
+    return buffer.to(tensor.device)
+
+
+def broadcast_module(module: torch.nn.Module, src: Optional[int] = 0):
+    """Copies the parameters and buffers of process `src` into `module` of every process"""
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for t in list(module.parameters()) + list(module.buffers()):
+            t.copy_(broadcast(t, src))
+
+
+def all_reduce(tensor: torch.Tensor, op=None) -> torch.Tensor:
+    """Returns the reduction (default: sum) of `tensor` over all processes"""
+    if not is_distributed():
+        return tensor
+    buffer = _communicated(tensor).clone()
+    dist.all_reduce(buffer, dist.ReduceOp.SUM if op is None else op)
+    return buffer.to(tensor.device)
+
+
+def all_gather(tensor: torch.Tensor, dim: Optional[int] = 0) -> list:
+    """Returns the `tensor` of every process, which must all have the same shape, in rank order"""
+    if not is_distributed():
+        return [tensor]
+    buffer = _communicated(tensor).contiguous()
+    gathered = [torch.empty_like(buffer) for _ in range(get_world_size())]
+    dist.all_gather(gathered, buffer)
+    return [t.to(tensor.device) for t in gathered]
+
+
+def all_gather_object(obj) -> list:
+    """Returns the picklable `obj` of every process, in rank order"""
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
+
+
+def average_tensors(tensors: list):
+    """Replaces `tensors` in-place with their average over all processes, with a single all-reduce"""
+    if not is_distributed() or not tensors:
+        return
+    flat = torch.cat([t.reshape(-1).float() for t in tensors])
+    flat = all_reduce(flat) / get_world_size()
+    for t, averaged in zip(tensors, flat.split([t.numel() for t in tensors])):
+        t.copy_(averaged.view_as(t))
+
+
+def average_gradients(optimizer: torch.optim.Optimizer):
+    """Averages the gradients of all parameters of `optimizer` over all processes, so that every process
+    takes the same step, the step of the global batch"""
+    average_tensors([p.grad for param_group in optimizer.param_groups for p in param_group['params']
+                     if p.grad is not None])
+
+
+def average_buffers(module: torch.nn.Module):
+    """Averages the floating point buffers of `module`, e.g. batch norm running statistics, over all processes"""
+    with torch.no_grad():
+        average_tensors([b for b in module.buffers() if b.is_floating_point()])
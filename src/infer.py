@@ -0,0 +1,165 @@
+import argparse
+import csv
+import sys
+import warnings
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from torch.utils.data import DataLoader
+
+sys.path.append('.')
+from model import Ensemble, ImageClassifier, resnet50
+from datasets import ImageList
+from lib import ResizeImage, get_uncertainty, norm
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def load_models(path: str, weights: Optional[str] = 'best'):
+    """Builds the classifier and the ensemble stored in a checkpoint of ``main.py --checkpoint``, or in any
+    file holding the ``classifier`` and ``esem`` state dicts, with the best snapshot unless `weights` is 'last'"""
+    checkpoint = torch.load(path, map_location='cpu')
+    state = checkpoint
+    if weights == 'best' and checkpoint.get('best_model') is not None:
+        state = checkpoint['best_model']
+
+    esem_state = state['esem']
+    if 'weight' in esem_state:
+        num_members, num_classes, features_dim = esem_state['weight'].shape
+    else:
+        # checkpoints saved before the heads were fused hold one `fcK` layer per member
+        num_members = sum(1 for key in esem_state if key.endswith('.weight'))
+        num_classes, features_dim = esem_state['fc1.weight'].shape
+
+    classifier = ImageClassifier(resnet50(pretrained=False), num_classes, bottleneck_dim=features_dim)
+    classifier.load_state_dict(state['classifier'])
+    esem = Ensemble(features_dim, num_classes, num_members)
+    esem.load_state_dict(esem_state)
+    return classifier.eval(), esem.eval()
+
+
+def write_columns(columns: Dict[str, np.ndarray], path: str):
+    """Writes equally long columns to a .csv, .npz or .parquet file, chosen by the extension of `path`"""
+    if path.endswith('.npz'):
+        np.savez_compressed(path, **columns)
+    elif path.endswith('.parquet'):
+        # pandas is only needed for parquet output
+        import pandas as pd
+        pd.DataFrame(columns).to_parquet(path, index=False)
+    else:
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns.keys())
+            writer.writerows(zip(*[column.tolist() for column in columns.values()]))
+
+
+def infer(data_loader: DataLoader, classifier, esem, args: argparse.Namespace) -> Dict[str, np.ndarray]:
+    """Streams the images of `data_loader` through the models and returns the columns of the output file"""
+    n = len(data_loader.dataset)
+    prediction = np.zeros(n, dtype=np.int32)
+    probability = np.zeros(n, dtype=np.float32)
+    confidence = np.zeros(n, dtype=np.float32)
+    margin = np.zeros(n, dtype=np.float32)
+    entropy = np.zeros(n, dtype=np.float32)
+    labels = np.zeros(n, dtype=np.int32)
+
+    start = 0
+    with torch.no_grad():
+        for i, (images, target) in enumerate(data_loader):
+            images = images.to(device, non_blocking=True)
+            with torch.autocast(device_type=device.type, dtype=getattr(torch, args.amp_dtype), enabled=args.amp):
+                logits, f = classifier(images)
+                y = esem(f)
+            values, indices = torch.max(F.softmax(logits.float(), -1), 1)
+            uncertainty = get_uncertainty(y)
+
+            end = start + target.size(0)
+            prediction[start:end] = indices.cpu().numpy()
+            probability[start:end] = values.cpu().numpy()
+            confidence[start:end] = uncertainty.confidence.cpu().numpy()
+            margin[start:end] = uncertainty.margin.cpu().numpy()
+            entropy[start:end] = uncertainty.entropy.cpu().numpy()
+            labels[start:end] = target.numpy()
+            start = end
+            if i % args.print_freq == 0:
+                print('[{}/{}]'.format(start, n))
+
+    # the same score as `validate`, min-max normalized over the reference scores, or else over the scored list
+    reference = np.load(args.reference) if args.reference is not None else {'margin': margin, 'entropy': entropy}
+    for name in ('margin', 'entropy'):
+        if not reference[name].max() > reference[name].min():
+            # e.g. a list of a single image, whose normalized scores would all be NaN
+            raise ValueError('the {} scores of {} have no range to normalize with, pass --reference'.format(
+                name, args.reference or args.data_list))
+    score = (norm(margin, reference['margin']) + 1 - norm(entropy, reference['entropy'])) / 2
+
+    columns = {
+        'path': np.array([path for path, _ in data_loader.dataset.data]),
+        'prediction': prediction,
+        'known': (score >= args.threshold).astype(np.int32),
+        'score': score.astype(np.float32),
+        'probability': probability,
+        'confidence': confidence,
+        'margin': margin,
+        'entropy': entropy,
+    }
+    if (labels >= 0).any():
+        columns['label'] = labels
+    return columns
+
+
+def main(args: argparse.Namespace):
+    if args.amp_dtype is None:
+        args.amp_dtype = 'float16' if device.type == 'cuda' else 'bfloat16'
+
+    classifier, esem = load_models(args.checkpoint, args.weights)
+    classifier, esem = classifier.to(device), esem.to(device)
+
+    transform = transforms.Compose([
+        ResizeImage(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+    dataset = ImageList(root=args.root, num_class=esem.weight.size(1), data_list_file=args.data_list,
+                        filter_class=None, transform=transform, shard_dir=args.shard_dir)
+    if args.reference is None:
+        warnings.warn('without --reference the scores are normalized over {}, so the decision of every image '
+                      'depends on the other images of the list'.format(args.data_list))
+    data_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
+                             pin_memory=torch.cuda.is_available())
+
+    columns = infer(data_loader, classifier, esem, args)
+    write_columns(columns, args.output)
+    print('{} images scored, {} known, written to {}'.format(len(dataset), columns['known'].sum(), args.output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predict the class and the known/unknown decision of every image '
+                                                 'of a data list with a trained model')
+    parser.add_argument('checkpoint', help='checkpoint written by main.py --checkpoint')
+    parser.add_argument('data_list', help='image list, one "path" or "path class_index" per line')
+    parser.add_argument('-o', '--output', default='predictions.csv',
+                        help='output file, .csv, .npz or .parquet (default: predictions.csv)')
+    parser.add_argument('--root', default='', help='root path of the images, for lists with relative paths')
+    parser.add_argument('--shard_dir', default=None, type=str,
+                        help='read the images from shards packed from the list by shards.py')
+    parser.add_argument('--weights', default='best', choices=['best', 'last'],
+                        help='use the best snapshot of the checkpoint or the last models (default: best)')
+    parser.add_argument('--threshold', default=0.6, type=float,
+                        help='images scoring at least this are decided known (default: 0.6)')
+    parser.add_argument('--reference', default=None, type=str,
+                        help='scores saved by main.py --dump_scores, whose ranges normalize the scores, so that '
+                             'the decision of an image does not depend on the list it is scored in. Without it '
+                             'the ranges of the scored list are used, which needs a list of several images')
+    parser.add_argument('-b', '--batch_size', default=256, type=int, help='mini-batch size (default: 256)')
+    parser.add_argument('-j', '--workers', default=4, type=int, help='number of data loading workers (default: 4)')
+    parser.add_argument('--amp', action='store_true', help='run the models with automatic mixed precision')
+    parser.add_argument('--amp_dtype', default=None, choices=['float16', 'bfloat16'],
+                        help='reduced precision dtype used by --amp (default: float16 on GPU, bfloat16 on CPU)')
+    parser.add_argument('-p', '--print_freq', default=100, type=int, help='print frequency (default: 100)')
+    args = parser.parse_args()
+    main(args)
@@ -1,9 +1,18 @@
+import collections
+import itertools
+import math
+import os
+import queue
+import random
+import threading
+from collections import namedtuple
 from typing import Optional
 from torch.optim.optimizer import Optimizer
 import sys
 import torch
 from torch.utils.data.dataloader import DataLoader
 import numpy as np
+from distributed import all_gather, get_rank, get_world_size, is_distributed
 
 
 class StepwiseLR:
@@ -104,25 +113,337 @@ def accuracy(output, target, topk=(1,)):
         return res
 
 
+def to_device(data, device, non_blocking: Optional[bool] = True):
+    """Moves every tensor in a nested structure of lists and tuples to `device`"""
+    if isinstance(data, torch.Tensor):
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, (list, tuple)):
+        return type(data)(to_device(d, device, non_blocking) for d in data)
+    return data
+
+
+def _record_stream(data, stream):
+    if isinstance(data, torch.Tensor):
+        data.record_stream(stream)
+    elif isinstance(data, (list, tuple)):
+        for d in data:
+            _record_stream(d, stream)
+
+
 class ForeverDataIterator:
-    """A data iterator that will never stop producing data"""
+    """A data iterator that will never stop producing data
 
-    def __init__(self, data_loader: DataLoader):
+    Parameters:
+        - **data_loader** (DataLoader): The data loader to iterate over, again and again
+        - **device** (torch.device, optional): If given, batches are moved to `device` with non-blocking copies
+        - **prefetch** (int, optional): Number of batches staged ahead of the one being consumed. On GPU up to \
+            `prefetch` batches are copied on a side stream while the current one computes, otherwise a \
+            background thread keeps up to `prefetch` batches ready. Errors of the background thread are \
+            raised by the next call. Default: 0
+    """
+
+    def __init__(self, data_loader: DataLoader, device: Optional[torch.device] = None, prefetch: Optional[int] = 0):
         self.data_loader = data_loader
+        self.device = device
+        self.epoch = 0
         self.iter = iter(self.data_loader)
-
-    def __next__(self):
+        self.stream = None
+        self.queue = None
+        if prefetch > 0 and device is not None and torch.device(device).type == 'cuda':
+            self.stream = torch.cuda.Stream(device)
+            self.staged = collections.deque()
+            for _ in range(prefetch):
+                self._stage()
+        elif prefetch > 0:
+            self.queue = queue.Queue(maxsize=prefetch)
+            threading.Thread(target=self._fill, daemon=True).start()
+
+    def _load(self):
         try:
             data = next(self.iter)
         except StopIteration:
+            # a DistributedSampler only reshuffles when told about the new epoch
+            self.epoch += 1
+            if hasattr(self.data_loader.sampler, 'set_epoch'):
+                self.data_loader.sampler.set_epoch(self.epoch)
             self.iter = iter(self.data_loader)
             data = next(self.iter)
         return data
 
+    def _stage(self):
+        with torch.cuda.stream(self.stream):
+            data = to_device(self._load(), self.device)
+            # each batch gets its own event, so that waiting for it does not wait for the batches behind it
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.staged.append((data, event))
+
+    def _fill(self):
+        try:
+            while True:
+                data = self._load()
+                if self.device is not None:
+                    data = to_device(data, self.device)
+                self.queue.put((data, None))
+        except BaseException as e:
+            # handed to the consumer, which would otherwise wait forever for the next batch
+            self.queue.put((None, e))
+
+    def __next__(self):
+        if self.stream is not None:
+            data, event = self.staged.popleft()
+            torch.cuda.current_stream(self.device).wait_event(event)
+            # the staged tensors are used on the compute stream, keep their memory from being reused early
+            _record_stream(data, torch.cuda.current_stream(self.device))
+            self._stage()
+            return data
+        if self.queue is not None:
+            data, error = self.queue.get()
+            if error is not None:
+                # the thread has stopped, every later call fails the same way
+                self.queue.put((None, error))
+                raise error
+            return data
+        data = self._load()
+        if self.device is not None:
+            data = to_device(data, self.device)
+        return data
+
     def __len__(self):
         return len(self.data_loader)
 
 
+EvaluationOutputs = namedtuple('EvaluationOutputs', ['logits', 'ensemble', 'labels'])
+EvaluationScores = namedtuple('EvaluationScores', ['prediction', 'confidence', 'margin', 'entropy', 'labels'])
+
+
+class EvaluationCache:
+    """Runs the classifier and the ensemble over an evaluation set once and reuses the outputs
+    until a parameter or buffer of either model is modified in-place, e.g. by an optimizer step.
+
+    In a distributed run, the data loader holds a ``DistributedSampler`` without shuffling and every process
+    only evaluates its shard of the set. The full outputs stay with their process, only the per-sample
+    scores of :meth:`scores` are gathered, so that normalizations over the whole set can be done everywhere.
+
+    Parameters:
+        - **data_loader** (DataLoader): Evaluation data loader yielding (images, labels)
+        - **model** (nn.Module): Classifier returning (logits, features)
+        - **esem** (nn.Module): Ensemble returning the stacked member probabilities
+        - **device** (torch.device): Device the models run on
+        - **transform** (callable, optional): Transform applied to each batch of images after it is moved \
+            to `device`, e.g. the normalization of cached uint8 images
+    """
+
+    def __init__(self, data_loader: DataLoader, model, esem, device, transform=None):
+        self.data_loader = data_loader
+        self.model = model
+        self.esem = esem
+        self.device = device
+        self.transform = transform
+        self._outputs = None
+        self._state = None
+        self._local_scores = None
+        self._scores = None
+
+    def state_version(self) -> tuple:
+        """Version counters of all parameters and buffers, bumped by every in-place update"""
+        return tuple(t._version for m in (self.model, self.esem)
+                     for t in itertools.chain(m.parameters(), m.buffers()))
+
+    def get(self) -> EvaluationOutputs:
+        """Returns (logits, ensemble probabilities, labels) of the evaluation samples of this process,
+        which are the whole set unless the run is distributed"""
+        state = self.state_version()
+        if self._outputs is None or state != self._state:
+            self._outputs = self.compute()
+            self._state = state
+            self._scores = None
+        return self._outputs
+
+    def scores(self, local: Optional[bool] = False) -> EvaluationScores:
+        """Returns the predicted class, the raw confidence, margin and entropy of the ensemble and the label
+        of every sample of the evaluation set, on the CPU. With `local`, only those of the samples of
+        this process are returned, on `device`."""
+        outputs = self.get()
+        if self._scores is None:
+            with torch.no_grad():
+                uncertainty = get_uncertainty(outputs.ensemble)
+                self._local_scores = EvaluationScores(outputs.logits.argmax(1), uncertainty.confidence,
+                                                      uncertainty.margin, uncertainty.entropy,
+                                                      outputs.labels.to(self.device))
+            n = len(self.data_loader.dataset)
+            self._scores = EvaluationScores(*(gather_shards(t, n).cpu() for t in self._local_scores))
+        return self._local_scores if local else self._scores
+
+    def compute(self) -> EvaluationOutputs:
+        self.model.eval()
+        self.esem.eval()
+
+        n = len(self.data_loader.sampler)
+        outputs = None
+        start = 0
+        with torch.no_grad():
+            for images, labels in self.data_loader:
+                images = images.to(self.device, non_blocking=True)
+                if self.transform is not None:
+                    images = self.transform(images)
+                logits, f = self.model(images)
+                y = self.esem(f)
+                if outputs is None:
+                    # buffers for the whole set are allocated once the output shapes are known
+                    outputs = EvaluationOutputs(logits.new_empty((n,) + logits.shape[1:]),
+                                                y.new_empty((y.size(0), n) + y.shape[2:]),
+                                                labels.new_empty((n,)))
+                end = start + labels.size(0)
+                outputs.logits[start:end] = logits
+                outputs.ensemble[:, start:end] = y
+                outputs.labels[start:end] = labels
+                start = end
+
+        if is_distributed():
+            # the sampler pads the shards to equal length by repeating samples, which must not be counted twice
+            m = len(range(get_rank(), len(self.data_loader.dataset), get_world_size()))
+            outputs = EvaluationOutputs(outputs.logits[:m], outputs.ensemble[:, :m], outputs.labels[:m])
+        return outputs
+
+
+def gather_shards(tensor: torch.Tensor, n: int) -> torch.Tensor:
+    """Reassembles the per-sample values of the shards of a ``DistributedSampler(shuffle=False)``, which deals
+    sample `i` to process `i % world_size`, into the values of all `n` samples in dataset order"""
+    if not is_distributed():
+        return tensor
+    world_size = get_world_size()
+    padded = tensor.new_zeros((math.ceil(n / world_size),) + tensor.shape[1:])
+    padded[:tensor.size(0)] = tensor
+    return torch.stack(all_gather(padded), dim=1).flatten(0, 1)[:n]
+
+
+def to_cpu(obj):
+    """Copies every tensor in a nested structure of dicts, lists and tuples to host memory"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state() -> dict:
+    """The states of all random number generators, made of plain Python values and tensors only, so that
+    checkpoints holding them load with ``torch.load(weights_only=True)``"""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'random': random.getstate(), 'numpy': (name, keys.tolist(), pos, has_gauss, cached_gaussian),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: dict):
+    random.setstate(state['random'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class AsyncCheckpointer:
+    """Saves checkpoints from a background thread.
+
+    Only the serialization and the file write run in the background. The copy of the state to host memory
+    is made synchronously on the calling thread, so that training can go on modifying the models while the
+    copy is saved. The file is written next to `path` and then renamed, so an interrupted write never
+    leaves a truncated checkpoint behind. A failed write, e.g. on a full disk, is raised by the next call
+    to :meth:`wait` or :meth:`save`.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._error = None
+
+    def save(self, state: dict, path: str):
+        self.wait()
+        state = to_cpu(state)
+        self._thread = threading.Thread(target=self._write, args=(state, path), daemon=True)
+        self._thread.start()
+
+    def _write(self, state: dict, path: str):
+        tmp_path = path + '.tmp'
+        try:
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException as e:
+            # handed to the training thread, which would otherwise go on as if the checkpoint was written
+            self._error = e
+
+    def wait(self):
+        """Blocks until the last checkpoint is written, raises the error of the write if it failed"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+class BestModelTracker:
+    """Keeps a host memory snapshot of the models achieving the best score so far.
+
+    Snapshots are copied into pinned host buffers with non-blocking copies, so an improvement
+    neither stalls the training device nor allocates a second copy of the models on it.
+
+    Parameters:
+        - **models** (nn.Module): The models to snapshot, by name
+    """
+
+    def __init__(self, **models):
+        self.models = models
+        self.best_score = None
+        self._buffers = None
+        self._event = None
+
+    def update(self, score: float) -> bool:
+        """Takes a snapshot if `score` is the best so far, returns whether it was"""
+        if self.best_score is not None and score <= self.best_score:
+            return False
+        # a plain float, e.g. not a numpy scalar, keeps checkpoints loadable with weights_only
+        self.best_score = float(score)
+        pin = torch.cuda.is_available()
+        if self._buffers is None:
+            self._buffers = {name: {k: torch.empty(v.shape, dtype=v.dtype, pin_memory=pin)
+                                    for k, v in model.state_dict().items()}
+                             for name, model in self.models.items()}
+        for name, model in self.models.items():
+            for k, v in model.state_dict().items():
+                self._buffers[name][k].copy_(v, non_blocking=True)
+        if pin:
+            self._event = torch.cuda.Event()
+            self._event.record()
+        return True
+
+    def synchronize(self):
+        """Waits for the last snapshot to reach host memory"""
+        if self._event is not None:
+            self._event.synchronize()
+            self._event = None
+
+    def state_dict(self) -> Optional[dict]:
+        """The snapshot of every model, or None before the first update"""
+        self.synchronize()
+        return self._buffers
+
+    def load_state_dict(self, state: Optional[dict], best_score: Optional[float]):
+        self._buffers = state
+        self.best_score = best_score
+
+    def restore(self):
+        """Loads the best snapshot back into the models"""
+        for name, model in self.models.items():
+            model.load_state_dict(self.state_dict()[name])
+
+
 class ResizeImage(object):
     """Resize the input PIL Image to the given size.
 
@@ -156,6 +477,16 @@ class AccuracyCounter:
     def add_total(self, index, amount=1):
         self.Ntotal[index] += amount
 
+    def update(self, index, correct):
+        """Adds a batch of samples at once
+
+        Parameters:
+            - **index** (array): Counter index of each sample, use ``length - 1`` for the unknown class
+            - **correct** (array): Whether each sample is correctly classified
+        """
+        self.Ntotal += np.bincount(index, minlength=self.length)
+        self.Ncorrect += np.bincount(index, weights=correct, minlength=self.length)
+
     def clear_zero(self):
         i = np.where(self.Ntotal == 0)
         self.Ncorrect = np.delete(self.Ncorrect, i)
@@ -176,28 +507,47 @@ class AccuracyCounter:
         return 2 * common_acc * open_acc / (common_acc + open_acc)
 
 
-def get_consistency(y_1, y_2, y_3, y_4, y_5):
-    y_1 = torch.unsqueeze(y_1, 1)
-    y_2 = torch.unsqueeze(y_2, 1)
-    y_3 = torch.unsqueeze(y_3, 1)
-    y_4 = torch.unsqueeze(y_4, 1)
-    y_5 = torch.unsqueeze(y_5, 1)
-    c = torch.cat((y_1, y_2, y_3, y_4, y_5), dim=1)
-    d = torch.std(c, 1)
-    consistency = torch.mean(d, 1)
-    return consistency
+Uncertainty = namedtuple('Uncertainty', ['entropy', 'confidence', 'margin', 'vote', 'consistency'])
 
 
-def get_entropy(y_1, y_2, y_3, y_4, y_5):
-    entropy1 = torch.sum(- y_1 * torch.log(y_1 + 1e-10), dim=1)
-    entropy2 = torch.sum(- y_2 * torch.log(y_2 + 1e-10), dim=1)
-    entropy3 = torch.sum(- y_3 * torch.log(y_3 + 1e-10), dim=1)
-    entropy4 = torch.sum(- y_4 * torch.log(y_4 + 1e-10), dim=1)
-    entropy5 = torch.sum(- y_5 * torch.log(y_5 + 1e-10), dim=1)
-    entropy_norm = np.log(y_1.size(1))
+def class_membership(labels: torch.Tensor, classes: list) -> torch.Tensor:
+    """Boolean mask of the samples whose label is one of `classes`, computed with a lookup table"""
+    lookup = torch.zeros(max(max(classes), int(labels.max())) + 1, dtype=torch.bool, device=labels.device)
+    lookup[classes] = True
+    return lookup[labels]
+
+
+def get_uncertainty(y: torch.Tensor) -> Uncertainty:
+    r"""Computes all ensemble uncertainty scores in a single pass
+
+    Parameters:
+        - **y** (tensor): Softmax outputs of the ensemble members, of shape :math:`(K, B, C)`
+        - **return** (Uncertainty): Per-sample scores of shape :math:`(B,)`:
+
+            - entropy: member-averaged entropy normalized by :math:`\log C`
+            - confidence: member-averaged max probability
+            - margin: member-averaged gap between the top two probabilities
+            - vote: max probability of the averaged prediction
+            - consistency: standard deviation across members, averaged over classes
+    """
+    # the log and the reductions are numerically unsafe in reduced precision
+    y = y.float()
+    top2, _ = torch.topk(y, 2, dim=-1)
+    top1 = top2[..., 0]
+    entropy = torch.sum(- y * torch.log(y + 1e-10), dim=-1).mean(0) / np.log(y.size(-1))
+    confidence = top1.mean(0)
+    margin = (top1 - top2[..., 1]).mean(0)
+    vote, _ = torch.max(y.mean(0), -1)
+    consistency = torch.std(y, 0).mean(-1)
+    return Uncertainty(entropy, confidence, margin, vote, consistency)
+
+
+def get_consistency(*y):
+    return get_uncertainty(torch.stack(y)).consistency
 
-    entropy = (entropy1 + entropy2 + entropy3 + entropy4 + entropy5) / (5 * entropy_norm)
-    return entropy
+
+def get_entropy(*y):
+    return get_uncertainty(torch.stack(y)).entropy
 
 
 def single_entropy(y_1):
@@ -207,36 +557,106 @@ def single_entropy(y_1):
     return entropy
 
 
-def get_confidence(y_1, y_2, y_3, y_4, y_5):
-    conf_1, indice_1 = torch.max(y_1, 1)
-    conf_2, indice_2 = torch.max(y_2, 1)
-    conf_3, indice_3 = torch.max(y_3, 1)
-    conf_4, indice_4 = torch.max(y_4, 1)
-    conf_5, indice_5 = torch.max(y_5, 1)
-    confidence = (conf_1 + conf_2 + conf_3 + conf_4 + conf_5) / 5
-    return confidence
+def get_confidence(*y):
+    return get_uncertainty(torch.stack(y)).confidence
+
+
+def get_vote_confidence(*y):
+    return get_uncertainty(torch.stack(y)).vote
+
+
+def get_marginal_confidence(*y):
+    return get_uncertainty(torch.stack(y)).margin
+
+
+PRCurve = namedtuple('PRCurve', ['thresholds', 'tp', 'fp', 'fn', 'precision', 'recall', 'f1'])
+
 
+def precision_recall(scores, labels, thresholds) -> PRCurve:
+    """Computes the confusion counts, precision, recall and F1 of ``scores >= threshold`` at every threshold at once
 
-def get_vote_confidence(y_1, y_2, y_3, y_4, y_5):
-    confidence, _ = torch.max((y_1 + y_2 + y_3 + y_4 + y_5) / 5, 1)
-    return confidence
+    Parameters:
+        - **scores** (array): Score of each sample
+        - **labels** (array): Whether each sample is positive
+        - **thresholds** (array): Any grid of thresholds
+        - **return** (PRCurve): Arrays with one entry per threshold
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels).astype(bool)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    # with samples sorted by descending score, the ones above a threshold are a prefix
+    order = np.argsort(-scores, kind='stable')
+    positives = np.concatenate(([0], np.cumsum(labels[order])))
+    num_selected = len(scores) - np.searchsorted(scores[order][::-1], thresholds, side='left')
+
+    tp = positives[num_selected]
+    fp = num_selected - tp
+    fn = positives[-1] - tp
+    recall = tp / (tp + fn + 1e-7)
+    precision = tp / (tp + fp + 1e-7)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f1 = 2 * recall * precision / (recall + precision)
+    return PRCurve(thresholds, tp, fp, fn, precision, recall, f1)
 
 
-def get_marginal_confidence(y_1, y_2, y_3, y_4, y_5):
-    conf_1, _ = torch.topk(y_1, 2, 1)
-    conf_2, _ = torch.topk(y_2, 2, 1)
-    conf_3, _ = torch.topk(y_3, 2, 1)
-    conf_4, _ = torch.topk(y_4, 2, 1)
-    conf_5, _ = torch.topk(y_5, 2, 1)
+ThresholdSweep = namedtuple('ThresholdSweep', ['thresholds', 'mean_accuracy', 'common_accuracy',
+                                               'unknown_accuracy', 'h_score'])
 
-    conf_1 = conf_1[:, 0] - conf_1[:, 1]
-    conf_2 = conf_2[:, 0] - conf_2[:, 1]
-    conf_3 = conf_3[:, 0] - conf_3[:, 1]
-    conf_4 = conf_4[:, 0] - conf_4[:, 1]
-    conf_5 = conf_5[:, 0] - conf_5[:, 1]
 
-    confidence = (conf_1 + conf_2 + conf_3 + conf_4 + conf_5) / 5
-    return confidence
+def threshold_sweep(score, prediction, label, num_source_classes: int, thresholds) -> ThresholdSweep:
+    """Open-set accuracies of `validate` at every threshold at once.
+
+    A sample of a source class is correct if ``score >= threshold`` and it is classified correctly, a sample
+    of any other class is correct if ``score < threshold``. Like :class:`AccuracyCounter`, classes without
+    samples are left out of the means.
+
+    Parameters:
+        - **score** (array): Normalized score of each sample, higher means more likely a source class
+        - **prediction** (array): Predicted class of each sample
+        - **label** (array): Class of each sample, source classes are ``0 .. num_source_classes - 1``
+        - **num_source_classes** (int): Number of source classes
+        - **thresholds** (array): Any grid of thresholds
+        - **return** (ThresholdSweep): Arrays with one entry per threshold
+    """
+    score = np.asarray(score, dtype=np.float64)
+    prediction = np.asarray(prediction)
+    label = np.asarray(label)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    num_thresholds = len(thresholds)
+
+    # counter index of every sample, target private samples share the last (unknown) counter
+    is_common = label < num_source_classes
+    index = np.where(is_common, label, num_source_classes)
+    total = np.bincount(index, minlength=num_source_classes + 1)
+
+    # bin j of a sample counts the sorted thresholds up to its score: it passes thresholds 0 .. j - 1 only
+    order = np.argsort(thresholds, kind='stable')
+    bins = np.searchsorted(thresholds[order], score, side='right')
+
+    eligible = is_common & (prediction == label)
+    passed = np.bincount(index[eligible] * (num_thresholds + 1) + bins[eligible],
+                         minlength=(num_source_classes + 1) * (num_thresholds + 1))
+    passed = passed.reshape(num_source_classes + 1, num_thresholds + 1)
+    correct_common = np.cumsum(passed[:, ::-1], axis=1)[:, ::-1][:num_source_classes, 1:]
+
+    rejected = np.bincount(bins[~is_common], minlength=num_thresholds + 1)
+    correct_unknown = np.cumsum(rejected)[:num_thresholds]
+
+    correct = np.zeros((num_source_classes + 1, num_thresholds))
+    correct[:num_source_classes, order] = correct_common
+    correct[num_source_classes, order] = correct_unknown
+
+    valid = total > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accuracy = correct[valid] / total[valid, None]
+        mean_accuracy = accuracy.mean(axis=0)
+        common_valid = valid[:num_source_classes]
+        common_accuracy = (correct[:num_source_classes][common_valid] /
+                           total[:num_source_classes][common_valid, None]).mean(axis=0)
+        unknown_accuracy = correct[num_source_classes] / total[num_source_classes]
+        h_score = 2 * common_accuracy * unknown_accuracy / (common_accuracy + unknown_accuracy)
+    return ThresholdSweep(thresholds, mean_accuracy, common_accuracy, unknown_accuracy, h_score)
 
 
 # def norm(t):
@@ -245,8 +665,10 @@ def get_marginal_confidence(y_1, y_2, y_3, y_4, y_5):
 #     t = (t - mean) / var
 #     return t
 
-def norm(x):
-    min_val = x.min()
-    max_val = x.max()
+def norm(x, reference=None):
+    """Min-max normalizes `x` with the range of `reference`, by default of `x` itself"""
+    reference = x if reference is None else reference
+    min_val = reference.min()
+    max_val = reference.max()
     x = (x - min_val) / (max_val - min_val)
     return x
\ No newline at end of file
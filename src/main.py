@@ -1,32 +1,37 @@
 import argparse
-import copy
 import os
 import random
+import subprocess
 import sys
+import tempfile
 import time
+from typing import Optional
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
 import torch.nn.functional as F
 import torch.nn.parallel
 import torch.utils.data
 import torch.utils.data.distributed
 import torchvision.transforms as transforms
-from matplotlib import pyplot as plt
-from sklearn.metrics import roc_auc_score, roc_curve
 from torch.optim import SGD
 from torch.utils.data import DataLoader
 
 sys.path.append('.')
 from model import DomainDiscriminator, Ensemble
 from model import DomainAdversarialLoss, ImageClassifier, resnet50
+from model import convert_split_batchnorm, set_batch_norm_splits
 import datasets
-from datasets import esem_dataloader
-from lib import AverageMeter, ProgressMeter, accuracy, ForeverDataIterator, AccuracyCounter, get_confidence
+from datasets import esem_dataloader, loader_kwargs, sampler_kwargs
+from distributed import init_distributed, get_rank, is_distributed, is_main_process
+from distributed import all_gather_object, all_reduce, average_buffers, average_gradients, broadcast, broadcast_module
+from lib import AverageMeter, ProgressMeter, accuracy, ForeverDataIterator, AccuracyCounter, get_uncertainty
+from lib import EvaluationCache, class_membership
+from lib import AsyncCheckpointer, BestModelTracker, get_rng_state, set_rng_state
 from lib import ResizeImage
-from lib import StepwiseLR, get_entropy, get_marginal_confidence, norm
+from lib import StepwiseLR, norm, precision_recall
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -35,15 +40,29 @@ import warnings
 warnings.simplefilter('ignore', UserWarning)
 
 
+def autocast(args: argparse.Namespace):
+    """Mixed-precision context for the forward passes, a no-op unless `--amp` is set"""
+    return torch.autocast(device_type=device.type, dtype=getattr(torch, args.amp_dtype), enabled=args.amp)
+
+
 def main(args: argparse.Namespace):
+    global device
     begin = time.time()
+    if args.dist_backend is not None:
+        device = init_distributed(args.dist_backend, args.dist_url)
     if args.seed is not None:
-        random.seed(args.seed)
-        torch.manual_seed(args.seed)
+        # processes draw different augmentations, the models are made identical by broadcasting below
+        random.seed(args.seed + get_rank())
+        torch.manual_seed(args.seed + get_rank())
         cudnn.deterministic = True
 
     cudnn.benchmark = True
 
+    if args.amp_dtype is None:
+        args.amp_dtype = 'float16' if device.type == 'cuda' else 'bfloat16'
+    # loss scaling is only needed for float16, bfloat16 has the dynamic range of float32
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp and args.amp_dtype == 'float16')
+
     # Data loading code
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
     train_transform = transforms.Compose([
@@ -69,27 +88,47 @@ def main(args: argparse.Namespace):
 
     dataset = datasets.Office31
     train_source_dataset = dataset(root=args.root, data_list_file=args.source, filter_class=source_classes,
-                                   transform=train_transform)
-    train_source_loader = DataLoader(train_source_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
+                                   transform=train_transform, shard_dir=args.source_shards,
+                                   list_cache_dir=args.list_cache_dir)
+    train_source_loader = DataLoader(train_source_dataset, batch_size=args.batch_size, drop_last=True,
+                                     **sampler_kwargs(train_source_dataset, True), **loader_kwargs(args))
     train_target_dataset = dataset(root=args.root, data_list_file=args.target, filter_class=target_classes,
-                                   transform=train_transform)
-    train_target_loader = DataLoader(train_target_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    val_dataset = dataset(root=args.root, data_list_file=args.target, filter_class=target_classes,
-                          transform=val_tranform)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
+                                   transform=train_transform, shard_dir=args.target_shards,
+                                   list_cache_dir=args.list_cache_dir)
+    train_target_loader = DataLoader(train_target_dataset, batch_size=args.batch_size, drop_last=True,
+                                     **sampler_kwargs(train_target_dataset, True), **loader_kwargs(args))
+    val_device_transform = None
+    if args.val_cache_dir is not None:
+        # decoded and cropped uint8 images are cached, the normalization runs on device
+        val_dataset = datasets.DecodedImageCache(
+            dataset(root=args.root, data_list_file=args.target, filter_class=target_classes,
+                    transform=transforms.Compose([ResizeImage(256), transforms.CenterCrop(224),
+                                                  transforms.PILToTensor()]),
+                    shard_dir=args.target_shards, list_cache_dir=args.list_cache_dir),
+            args.val_cache_dir)
+        val_device_transform = lambda images: normalize(images.float().div_(255))
+    else:
+        val_dataset = dataset(root=args.root, data_list_file=args.target, filter_class=target_classes,
+                              transform=val_tranform, shard_dir=args.target_shards,
+                              list_cache_dir=args.list_cache_dir)
+    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, **sampler_kwargs(val_dataset, False),
+                            **loader_kwargs(args))
 
     test_loader = val_loader
 
-    train_source_iter = ForeverDataIterator(train_source_loader)
-    train_target_iter = ForeverDataIterator(train_target_loader)
+    train_source_iter = ForeverDataIterator(train_source_loader, device, args.prefetch)
+    train_target_iter = ForeverDataIterator(train_target_loader, device, args.prefetch)
 
     # create model
     backbone = resnet50(pretrained=True)
-    classifier = ImageClassifier(backbone, train_source_dataset.num_classes).to(device)
+    classifier = ImageClassifier(backbone, train_source_dataset.num_classes)
+    if args.concat_forward and args.domain_bn:
+        classifier = convert_split_batchnorm(classifier)
+    classifier = classifier.to(device)
     domain_discri = DomainDiscriminator(in_feature=classifier.features_dim, hidden_size=1024).to(device)
     esem = Ensemble(classifier.features_dim, train_source_dataset.num_classes).to(device)
+    for module in (classifier, domain_discri, esem):
+        broadcast_module(module)
     # proto_cls = Cos_Classifier(classifier.features_dim, train_source_dataset.num_classes, scale=4).to(device)
 
     # define optimizer and lr scheduler
@@ -99,17 +138,14 @@ def main(args: argparse.Namespace):
 
     optimizer_esem = SGD(esem.get_parameters(), args.lr, momentum=args.momentum,
                          weight_decay=args.weight_decay, nesterov=True)
-    lr_scheduler1 = StepwiseLR(optimizer_esem, init_lr=args.lr, gamma=0.001, decay_rate=0.75)
-    lr_scheduler2 = StepwiseLR(optimizer_esem, init_lr=args.lr, gamma=0.001, decay_rate=0.75)
-    lr_scheduler3 = StepwiseLR(optimizer_esem, init_lr=args.lr, gamma=0.001, decay_rate=0.75)
-    lr_scheduler4 = StepwiseLR(optimizer_esem, init_lr=args.lr, gamma=0.001, decay_rate=0.75)
-    lr_scheduler5 = StepwiseLR(optimizer_esem, init_lr=args.lr, gamma=0.001, decay_rate=0.75)
+    # the members are trained in the same steps, so one schedule serves the whole ensemble
+    lr_scheduler_esem = StepwiseLR(optimizer_esem, init_lr=args.lr, gamma=0.001, decay_rate=0.75)
 
     optimizer_pre = SGD(esem.get_parameters() + classifier.get_parameters(), args.lr, momentum=args.momentum,
                         weight_decay=args.weight_decay, nesterov=True)
     lr_scheduler_pre = StepwiseLR(optimizer_pre, init_lr=args.lr, gamma=0.001, decay_rate=0.75)
 
-    esem_iter1, esem_iter2, esem_iter3, esem_iter4, esem_iter5 = esem_dataloader(args, source_classes)
+    esem_iter = esem_dataloader(args, source_classes, device)
 
     # define loss function
     domain_adv = DomainAdversarialLoss(domain_discri, reduction='none').to(device)
@@ -123,11 +159,11 @@ def main(args: argparse.Namespace):
     # pretrain_model_path = f"models/{ds}/scw_{src[:-4]}_{tgt[:-4]}_pretrain.pth"
     # if not os.path.exists(pretrain_model_path):
     #     for epoch in range(args.pre_epochs):
-    #         pretrain(train_source_iter, esem_iter1, esem_iter2, esem_iter3, esem_iter4, esem_iter5, classifier,
-    #                  esem, optimizer_pre, args, epoch, lr_scheduler_pre)
+    #         pretrain(train_source_iter, esem_iter, classifier, esem, optimizer_pre, scaler, args, epoch,
+    #                  lr_scheduler_pre)
     #
-    #         evaluate_source_common(val_loader, classifier, esem, source_classes, args)
-    #         auc = plot_roc(val_loader, classifier, esem, source_classes, args)
+    #         evaluate_source_common(val_cache, source_classes, args)
+    #         auc = plot_roc(val_cache, source_classes, args)
     #         print(f"Got AUC {auc:.4f}")
     #
     #     state = {'classifier': classifier.state_dict(), 'esem': esem.state_dict()}
@@ -139,53 +175,135 @@ def main(args: argparse.Namespace):
     #     classifier.load_state_dict(checkpoint['classifier'])
     #     esem.load_state_dict(checkpoint['esem'])
     #
-    #     plot_pr(val_loader, classifier, esem, source_classes, args)
+    #     plot_pr(val_cache, source_classes, args)
+
+    # target outputs shared by every evaluation pass until the models are updated again
+    val_cache = EvaluationCache(val_loader, classifier, esem, device, val_device_transform)
+    test_cache = val_cache if test_loader is val_loader else EvaluationCache(test_loader, classifier, esem, device,
+                                                                             val_device_transform)
 
     target_score_upper = torch.zeros(1).to(device)
     target_score_lower = torch.zeros(1).to(device)
-    source_class_weight = torch.ones(len(source_classes))
+    if args.source_class_weight is not None:
+        # fixed per-class weights, one value per line, for repeatable runs
+        source_class_weight = torch.from_numpy(np.loadtxt(args.source_class_weight, dtype=np.float32, ndmin=1))
+        if len(source_class_weight) != len(source_classes):
+            raise ValueError('{} holds {} class weights, but there are {} source classes'.format(
+                args.source_class_weight, len(source_class_weight), len(source_classes)))
+    else:
+        source_class_weight = torch.ones(len(source_classes))
+    source_class_weight = source_class_weight.to(device)
     print(source_class_weight)
 
+    # the ensemble is part of the snapshot, since validate depends on it too
+    best_model = BestModelTracker(classifier=classifier, esem=esem)
+    start_epoch = 0
+    if args.resume:
+        checkpoint = torch.load(args.resume, map_location='cpu')
+        classifier.load_state_dict(checkpoint['classifier'])
+        domain_discri.load_state_dict(checkpoint['domain_discri'])
+        esem.load_state_dict(checkpoint['esem'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        optimizer_esem.load_state_dict(checkpoint['optimizer_esem'])
+        scaler.load_state_dict(checkpoint['scaler'])
+        lr_scheduler.iter_num = checkpoint['lr_scheduler']
+        lr_scheduler_esem.iter_num = checkpoint['lr_scheduler_esem']
+        domain_adv.grl.iter_num = checkpoint['grl']
+        target_score_upper = checkpoint['target_score_upper'].to(device)
+        target_score_lower = checkpoint['target_score_lower'].to(device)
+        source_class_weight = checkpoint['source_class_weight'].to(device)
+        best_model.load_state_dict(checkpoint['best_model'], checkpoint['best_acc1'])
+        start_epoch = checkpoint['epoch'] + 1
+        # only the random streams and the schedules resume where they stopped: the data iterators start a new pass
+        # over their sets, and a DistributedSampler shuffles it in the order of its first epoch again
+        if get_rank() < len(checkpoint['rng']):
+            set_rng_state(checkpoint['rng'][get_rank()])
+        print("resumed from {} at epoch {}".format(args.resume, start_epoch))
+    checkpointer = AsyncCheckpointer()
+
+    if args.evaluate:
+        # score the best models of the checkpoint only, sharded over the processes of a distributed run
+        if best_model.state_dict() is not None:
+            best_model.restore()
+        evaluate_source_common(test_cache, source_classes, args)
+        acc1 = validate(test_cache, source_classes, args)
+        print("test_acc1 = {:3.3f}".format(acc1))
+        if args.dump_scores is not None:
+            dump_scores(test_cache, source_classes, args.dump_scores)
+        return
+
+    if args.esem_bank > 0:
+        # removed by `cleanup` below, or when the interpreter exits after an error or an interrupt
+        bank_dir = tempfile.TemporaryDirectory(prefix='esem_bank_', dir=args.esem_bank_dir)
+        bank_path = os.path.join(bank_dir.name, 'bank.npy')
+
     # start training
-    best_acc1 = 0.
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
         # train for one epoch
         target_score_upper, target_score_lower = train(train_source_iter, train_target_iter, classifier, domain_adv,
                                                        esem, optimizer, lr_scheduler, epoch, source_class_weight,
-                                                       target_score_upper, target_score_lower, args)
-
-        train_esem(esem_iter1, classifier, esem, optimizer_esem, lr_scheduler1, epoch, args, index=1)
-        train_esem(esem_iter2, classifier, esem, optimizer_esem, lr_scheduler2, epoch, args, index=2)
-        train_esem(esem_iter3, classifier, esem, optimizer_esem, lr_scheduler3, epoch, args, index=3)
-        train_esem(esem_iter4, classifier, esem, optimizer_esem, lr_scheduler4, epoch, args, index=4)
-        train_esem(esem_iter5, classifier, esem, optimizer_esem, lr_scheduler5, epoch, args, index=5)
-
-        source_class_weight = evaluate_source_common(val_loader, classifier, esem, source_classes, args)
-        mask = torch.where(source_class_weight > 0.1)
-        source_class_weight = torch.zeros_like(source_class_weight)
-        source_class_weight[mask] = 1
+                                                       target_score_upper, target_score_lower, scaler, args)
+
+        if args.esem_bank > 0:
+            bank, bank_labels = build_feature_bank(esem_iter, classifier, esem.num_members,
+                                                   bank_path, args)
+            train_esem_bank(bank, bank_labels, esem, optimizer_esem, lr_scheduler_esem, scaler, epoch, args)
+            del bank
+        else:
+            train_esem(esem_iter, classifier, esem, optimizer_esem, lr_scheduler_esem, scaler, epoch, args)
+
+        estimated_weight = evaluate_source_common(val_cache, source_classes, args)
+        if args.source_class_weight is None:
+            source_class_weight = broadcast((estimated_weight > 0.1).float())
         print(source_class_weight)
 
         # evaluate on validation set
-        acc1 = validate(val_loader, classifier, esem, source_classes, args)
+        acc1 = validate(val_cache, source_classes, args)
 
         # remember best acc@1 and save checkpoint
-        if acc1 > best_acc1:
-            best_model = copy.deepcopy(classifier.state_dict())
-        best_acc1 = max(acc1, best_acc1)
-
-    print("best_acc1 = {:3.3f}".format(best_acc1))
+        best_model.update(acc1)
+
+        checkpoint_epoch = (epoch + 1) % args.checkpoint_freq == 0 or epoch + 1 == args.epochs
+        if args.checkpoint is not None and checkpoint_epoch:
+            # the random streams of every process, each continues its own after a resume
+            rng = all_gather_object(get_rng_state())
+            if is_main_process():
+                checkpointer.save({
+                    'epoch': epoch,
+                    'classifier': classifier.state_dict(),
+                    'domain_discri': domain_discri.state_dict(),
+                    'esem': esem.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'optimizer_esem': optimizer_esem.state_dict(),
+                    'scaler': scaler.state_dict(),
+                    'lr_scheduler': lr_scheduler.iter_num,
+                    'lr_scheduler_esem': lr_scheduler_esem.iter_num,
+                    'grl': domain_adv.grl.iter_num,
+                    'target_score_upper': target_score_upper,
+                    'target_score_lower': target_score_lower,
+                    'source_class_weight': source_class_weight,
+                    'best_acc1': best_model.best_score,
+                    'best_model': best_model.state_dict(),
+                    'rng': rng,
+                }, args.checkpoint)
+
+    checkpointer.wait()
+    print("best_acc1 = {:3.3f}".format(best_model.best_score))
+    if args.esem_bank > 0:
+        bank_dir.cleanup()
 
     # evaluate on test set
-    classifier.load_state_dict(best_model)
-    acc1 = validate(test_loader, classifier, esem, source_classes, args)
+    best_model.restore()
+    acc1 = validate(test_cache, source_classes, args)
     print("test_acc1 = {:3.3f}".format(acc1))
+    if args.dump_scores is not None:
+        dump_scores(test_cache, source_classes, args.dump_scores)
     end = time.time()
     print(f"Total experiment time: {(end - begin) // 60}min")
 
 
-def pretrain(train_source_iter: ForeverDataIterator, esem_iter1, esem_iter2, esem_iter3, esem_iter4, esem_iter5, model,
-             esem, optimizer, args, epoch, lr_scheduler):
+def pretrain(train_source_iter: ForeverDataIterator, esem_iter: ForeverDataIterator, model, esem, optimizer, scaler,
+             args, epoch, lr_scheduler):
     losses = AverageMeter('Loss', ':6.2f')
     cls_accs = AverageMeter('Cls Acc', ':3.1f')
     progress = ProgressMeter(
@@ -202,54 +320,30 @@ def pretrain(train_source_iter: ForeverDataIterator, esem_iter1, esem_iter2, ese
         x_s, labels_s = next(train_source_iter)
         x_s = x_s.to(device)
         labels_s = labels_s.to(device)
-        y_s, f_s = model(x_s)
-        cls_loss = F.cross_entropy(y_s, labels_s)
-
-        x_s1, labels_s1 = next(esem_iter1)
-        x_s1 = x_s1.to(device)
-        labels_s1 = labels_s1.to(device)
-        y_s1, f_s1 = model(x_s1)
-        y_s1 = esem(f_s1, index=1)
-        loss1 = F.cross_entropy(y_s1, labels_s1)
-
-        x_s2, labels_s2 = next(esem_iter2)
-        x_s2 = x_s2.to(device)
-        labels_s2 = labels_s2.to(device)
-        y_s2, f_s2 = model(x_s2)
-        y_s2 = esem(f_s2, index=2)
-        loss2 = F.cross_entropy(y_s2, labels_s2)
-
-        x_s3, labels_s3 = next(esem_iter3)
-        x_s3 = x_s3.to(device)
-        labels_s3 = labels_s3.to(device)
-        y_s3, f_s3 = model(x_s3)
-        y_s3 = esem(f_s3, index=3)
-        loss3 = F.cross_entropy(y_s3, labels_s3)
-
-        x_s4, labels_s4 = next(esem_iter4)
-        x_s4 = x_s4.to(device)
-        labels_s4 = labels_s4.to(device)
-        y_s4, f_s4 = model(x_s4)
-        y_s4 = esem(f_s4, index=4)
-        loss4 = F.cross_entropy(y_s4, labels_s4)
-
-        x_s5, labels_s5 = next(esem_iter5)
-        x_s5 = x_s5.to(device)
-        labels_s5 = labels_s5.to(device)
-        y_s5, f_s5 = model(x_s5)
-        y_s5 = esem(f_s5, index=5)
-        loss5 = F.cross_entropy(y_s5, labels_s5)
-
-        cls_acc = accuracy(y_s1, labels_s1)[0]
-        cls_accs.update(cls_acc.item(), x_s1.size(0))
-
-        loss = loss1 + loss2 + loss3 + loss4 + loss5 + cls_loss
-        losses.update(loss.item(), x_s1.size(0))
+        with autocast(args):
+            y_s, f_s = model(x_s)
+            loss = F.cross_entropy(y_s, labels_s)
+
+        # one decoded batch provides the augmented view of every ensemble member
+        x_views, labels_v = next(esem_iter)
+        labels_v = labels_v.to(device)
+        for index, x_v in enumerate(x_views, start=1):
+            with autocast(args):
+                _, f_v = model(x_v.to(device))
+                y_v = esem(f_v, index=index)
+                loss = loss + F.cross_entropy(y_v, labels_v)
+            if index == 1:
+                cls_acc = accuracy(y_v, labels_v)[0]
+                cls_accs.update(cls_acc.item(), x_v.size(0))
+
+        losses.update(loss.item(), labels_v.size(0))
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        average_gradients(optimizer)
+        scaler.step(optimizer)
+        scaler.update()
 
         if i % (args.print_freq) == 0:
             progress.display(i)
@@ -258,7 +352,7 @@ def pretrain(train_source_iter: ForeverDataIterator, esem_iter1, esem_iter2, ese
 def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverDataIterator,
           model: ImageClassifier, domain_adv: DomainAdversarialLoss, esem, optimizer: SGD,
           lr_scheduler: StepwiseLR, epoch: int, source_class_weight, target_score_upper, target_score_lower,
-          args: argparse.Namespace):
+          scaler, args: argparse.Namespace):
     batch_time = AverageMeter('Time', ':4.2f')
     losses = AverageMeter('Loss', ':4.2f')
     cls_accs = AverageMeter('Cls Acc', ':4.1f')
@@ -274,6 +368,8 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
     model.train()
     domain_adv.train()
     esem.eval()
+    if args.concat_forward and args.domain_bn:
+        set_batch_norm_splits(model, 2)
 
     end = time.time()
     for i in range(args.iters_per_epoch):
@@ -286,24 +382,35 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         x_t = x_t.to(device)
         labels_s = labels_s.to(device)
 
-        # compute output
-        y_s, f_s = model(x_s)
-        y_t, f_t = model(x_t)
-
-        with torch.no_grad():
-            yt_1, yt_2, yt_3, yt_4, yt_5 = esem(f_t)
-            confidence = get_marginal_confidence(yt_1, yt_2, yt_3, yt_4, yt_5)
-            entropy = get_entropy(yt_1, yt_2, yt_3, yt_4, yt_5)
-            w_t = (1 - entropy + confidence) / 2
-            target_score_upper = target_score_upper * 0.01 + w_t.max() * 0.99
-            target_score_lower = target_score_lower * 0.01 + w_t.min() * 0.99
-            w_t = (w_t - target_score_lower) / (target_score_upper - target_score_lower)
-            w_s = torch.tensor([source_class_weight[i] for i in labels_s]).to(device)
-
-        cls_loss = F.cross_entropy(y_s, labels_s)
-        transfer_loss = domain_adv(f_s, f_t, w_s.detach(), w_t.to(device).detach())
-        domain_acc = domain_adv.domain_discriminator_accuracy
-        loss = cls_loss + transfer_loss * args.trade_off
+        with autocast(args):
+            # compute output
+            if args.concat_forward:
+                y, f = model(torch.cat((x_s, x_t), dim=0))
+                y_s, y_t = y.split([x_s.size(0), x_t.size(0)], dim=0)
+                f_t = f[x_s.size(0):]
+            else:
+                y_s, f_s = model(x_s)
+                y_t, f_t = model(x_t)
+
+            with torch.no_grad():
+                uncertainty = get_uncertainty(esem(f_t))
+                w_t = (1 - uncertainty.entropy + uncertainty.margin) / 2
+                # the extremes of the global batch, so that every process tracks the same range
+                batch_upper, batch_lower = all_reduce(torch.stack([w_t.max(), -w_t.min()]), dist.ReduceOp.MAX) \
+                    if is_distributed() else (w_t.max(), -w_t.min())
+                target_score_upper = target_score_upper * 0.01 + batch_upper * 0.99
+                target_score_lower = target_score_lower * 0.01 - batch_lower * 0.99
+                w_t = (w_t - target_score_lower) / (target_score_upper - target_score_lower)
+                w_s = source_class_weight[labels_s]
+
+            cls_loss = F.cross_entropy(y_s, labels_s)
+            if args.concat_forward:
+                # the discriminator takes the features of both domains in one batch, as they come out of the model
+                transfer_loss = domain_adv.forward_concat(f, w_s.detach(), w_t.to(device).detach())
+            else:
+                transfer_loss = domain_adv(f_s, f_t, w_s.detach(), w_t.to(device).detach())
+            domain_acc = domain_adv.domain_discriminator_accuracy
+            loss = cls_loss + transfer_loss * args.trade_off
 
         cls_acc = accuracy(y_s, labels_s)[0]
 
@@ -315,8 +422,10 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        average_gradients(optimizer)
+        scaler.step(optimizer)
+        scaler.update()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -325,16 +434,21 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         if i % args.print_freq == 0:
             progress.display(i)
 
+    if args.concat_forward and args.domain_bn:
+        set_batch_norm_splits(model, 1)
+    average_buffers(model)
+
     return target_score_upper, target_score_lower
 
 
-def train_esem(train_source_iter, model, esem, optimizer, lr_scheduler, epoch, args, index):
+def train_esem(esem_iter: ForeverDataIterator, model, esem, optimizer, lr_scheduler: StepwiseLR, scaler, epoch,
+               args):
     losses = AverageMeter('Loss', ':4.2f')
     cls_accs = AverageMeter('Cls Acc', ':5.1f')
     progress = ProgressMeter(
         args.iters_per_epoch // 2,
         [losses, cls_accs],
-        prefix="Esem: [{}-{}]".format(epoch, index))
+        prefix="Esem: [{}]".format(epoch))
 
     model.eval()
     esem.train()
@@ -342,72 +456,122 @@ def train_esem(train_source_iter, model, esem, optimizer, lr_scheduler, epoch, a
     for i in range(args.iters_per_epoch // 2):
         lr_scheduler.step()
 
-        x_s, labels_s = next(train_source_iter)
-        x_s = x_s.to(device)
+        x_views, labels_s = next(esem_iter)
         labels_s = labels_s.to(device)
-
-        # compute output
-        with torch.no_grad():
-            y_s, f_s = model(x_s)
-        y_s = esem(f_s.detach(), index)
-
-        loss = F.cross_entropy(y_s, labels_s)
-        cls_acc = accuracy(y_s, labels_s)[0]
-
-        losses.update(loss.item(), x_s.size(0))
-        cls_accs.update(cls_acc.item(), x_s.size(0))
+        num_members, batch_size = len(x_views), labels_s.size(0)
+
+        # the frozen backbone encodes the views of all members in one pass,
+        # then every member classifies the features of its own view
+        with autocast(args):
+            with torch.no_grad():
+                _, f_s = model(torch.cat([x_s.to(device) for x_s in x_views]))
+            y_s = esem.member_logits(f_s.detach().view(num_members, batch_size, -1))
+            # the heads share no parameters, so the summed member losses train them independently
+            loss = F.cross_entropy(y_s.flatten(0, 1), labels_s.repeat(num_members)) * num_members
+        cls_acc = accuracy(y_s.flatten(0, 1), labels_s.repeat(num_members))[0]
+        losses.update(loss.item() / num_members, batch_size * num_members)
+        cls_accs.update(cls_acc.item(), batch_size * num_members)
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        average_gradients(optimizer)
+        scaler.step(optimizer)
+        scaler.update()
 
         if i % args.print_freq == 0:
             progress.display(i)
 
 
-def validate(val_loader: DataLoader, model: ImageClassifier, esem, source_classes: list,
-             args: argparse.Namespace) -> float:
-    # switch to evaluate mode
+def build_feature_bank(esem_iter, model, num_members, path, args):
+    """Encodes `args.esem_bank` augmented copies of every source image of `esem_iter` for every ensemble member
+    with the frozen classifier, into a float16 array of shape (num_members, copies * N, features_dim)
+    memory-mapped at `path`. Row `c * N + j` holds the c-th copy of image j.
+
+    In a distributed run, every process only encodes the N images of its shard of the source set."""
     model.eval()
-    esem.eval()
+    dataset = esem_iter.data_loader.dataset
+    loader = DataLoader(dataset, batch_size=args.batch_size, collate_fn=esem_iter.data_loader.collate_fn,
+                        **sampler_kwargs(dataset, False), **loader_kwargs(args))
+    augment = getattr(esem_iter, 'augment', None)
 
-    all_confidence = list()
-    all_entropy = list()
-    all_indices = list()
-    all_labels = list()
+    n = len(loader.sampler)
+    bank = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16,
+                                     shape=(num_members, args.esem_bank * n, model.features_dim))
+    labels = torch.zeros(n, dtype=torch.long)
 
     with torch.no_grad():
-        for i, (images, labels) in enumerate(val_loader):
-            images = images.to(device)
-            labels = labels.to(device)
+        for c in range(args.esem_bank):
+            start = 0
+            for batch in loader:
+                x_views, labels_s = batch if augment is None else augment(batch)
+                end = start + labels_s.size(0)
+                for k, x_s in enumerate(x_views):
+                    _, f_s = model(x_s.to(device, non_blocking=True))
+                    bank[k, c * n + start:c * n + end] = f_s.half().cpu().numpy()
+                labels[start:end] = labels_s
+                start = end
+    bank.flush()
+    return bank, labels
+
+
+def train_esem_bank(bank, bank_labels, esem, optimizer, lr_scheduler, scaler, epoch, args):
+    """Same schedule as `train_esem`, but trains the ensemble heads on features drawn from the bank"""
+    losses = AverageMeter('Loss', ':4.2f')
+    cls_accs = AverageMeter('Cls Acc', ':5.1f')
+    progress = ProgressMeter(
+        args.iters_per_epoch // 2,
+        [losses, cls_accs],
+        prefix="Esem: [{}]".format(epoch))
+
+    esem.train()
+    num_members, num_rows, _ = bank.shape
+
+    for i in range(args.iters_per_epoch // 2):
+        lr_scheduler.step()
 
-            output, f = model(images)
-            values, indices = torch.max(F.softmax(output, -1), 1)
+        loss = 0.
+        for index in range(1, num_members + 1):
+            # the rows are random, sorting them only makes the reads go through the memory-mapped bank in order
+            rows, _ = torch.randint(num_rows, (args.batch_size,)).sort()
+            f_s = torch.from_numpy(bank[index - 1, rows.numpy()]).to(device).float()
+            labels_s = bank_labels[rows % len(bank_labels)].to(device)
+
+            with autocast(args):
+                y_s = esem(f_s, index)
+                member_loss = F.cross_entropy(y_s, labels_s)
+            cls_acc = accuracy(y_s, labels_s)[0]
+            losses.update(member_loss.item(), f_s.size(0))
+            cls_accs.update(cls_acc.item(), f_s.size(0))
+            loss = loss + member_loss
 
-            yt_1, yt_2, yt_3, yt_4, yt_5 = esem(f)
-            confidence = get_marginal_confidence(yt_1, yt_2, yt_3, yt_4, yt_5)
-            entropy = get_entropy(yt_1, yt_2, yt_3, yt_4, yt_5)
+        # compute gradient and do SGD step
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        average_gradients(optimizer)
+        scaler.step(optimizer)
+        scaler.update()
 
-            all_confidence.extend(confidence)
-            all_entropy.extend(entropy)
-            all_indices.extend(indices)
-            all_labels.extend(labels)
+        if i % args.print_freq == 0:
+            progress.display(i)
 
-    all_confidence = norm(torch.tensor(all_confidence))
-    all_entropy = norm(torch.tensor(all_entropy))
+
+def validate(val_cache: EvaluationCache, source_classes: list, args: argparse.Namespace) -> float:
+    scores = val_cache.scores()
+    all_indices = scores.prediction
+    all_labels = scores.labels
+    all_confidence = norm(scores.margin)
+    all_entropy = norm(scores.entropy)
     all_score = (all_confidence + 1 - all_entropy) / 2
 
+    # samples of target private classes are all counted in the last (unknown) counter
+    is_common = class_membership(all_labels, source_classes)
+    index = torch.where(is_common, all_labels, torch.full_like(all_labels, len(source_classes)))
+    correct = torch.where(is_common, (all_score >= args.threshold) & (all_indices == all_labels),
+                          all_score < args.threshold)
+
     counters = AccuracyCounter(len(source_classes) + 1)
-    for (each_indice, each_label, score) in zip(all_indices, all_labels, all_score):
-        if each_label in source_classes:
-            counters.add_total(each_label)
-            if score >= args.threshold and each_indice == each_label:
-                counters.add_correct(each_label)
-        else:
-            counters.add_total(-1)
-            if score < args.threshold:
-                counters.add_correct(-1)
+    counters.update(index.numpy(), correct.numpy())
 
     print('---counters---')
     print(counters.each_accuracy())
@@ -417,46 +581,40 @@ def validate(val_loader: DataLoader, model: ImageClassifier, esem, source_classe
     return counters.mean_accuracy()
 
 
-def plot_roc(val_loader: DataLoader, model: ImageClassifier, esem, source_classes: list, args: argparse.Namespace):
-    # switch to evaluate mode
-    model.eval()
-    esem.eval()
-
-    all_confidence = list()
-    all_marginal_confidence = list()
-    all_entropy = list()
-    all_labels = list()
-
-    with torch.no_grad():
-        for i, (images, labels) in enumerate(val_loader):
-            images = images.to(device)
-
-            _, f = model(images)
-            yt_1, yt_2, yt_3, yt_4, yt_5 = esem(f)
-            confidence = get_confidence(yt_1, yt_2, yt_3, yt_4, yt_5)
-            marginal_confidence = get_marginal_confidence(yt_1, yt_2, yt_3, yt_4, yt_5)
-            entropy = get_entropy(yt_1, yt_2, yt_3, yt_4, yt_5)
-
-            all_confidence.extend(confidence)
-            all_marginal_confidence.extend(marginal_confidence)
-            all_entropy.extend(entropy)
-            all_labels.extend(labels)
-
-    all_confidence = norm(torch.tensor(all_confidence))
-    all_marginal_confidence = norm(torch.tensor(all_marginal_confidence))
-    all_entropy = norm(torch.tensor(all_entropy))
+def dump_scores(val_cache: EvaluationCache, source_classes: list, path: str):
+    """Saves the prediction, label and raw uncertainty scores of every sample, for `threshold_sweep.py`
+    and as the ``--reference`` of `infer.py`"""
+    scores = val_cache.scores()
+    if not is_main_process():
+        return
+
+    np.savez_compressed(path, prediction=scores.prediction.numpy().astype(np.int32),
+                        label=scores.labels.numpy().astype(np.int32),
+                        confidence=scores.confidence.numpy().astype(np.float32),
+                        margin=scores.margin.numpy().astype(np.float32),
+                        entropy=scores.entropy.numpy().astype(np.float32),
+                        num_source_classes=len(source_classes))
+    print("scores written to {}".format(path))
+
+
+def plot_roc(val_cache: EvaluationCache, source_classes: list, args: argparse.Namespace):
+    # plotting dependencies are heavy to import and only needed here
+    from matplotlib import pyplot as plt
+    from sklearn.metrics import roc_auc_score, roc_curve
+
+    scores = val_cache.scores()
+    all_labels = scores.labels
+    all_confidence = norm(scores.confidence)
+    all_marginal_confidence = norm(scores.margin)
+    all_entropy = norm(scores.entropy)
     all_score_a = (all_confidence)
     all_score_b = (all_marginal_confidence)
     all_score_c = (1 - all_entropy)
 
-    common_labels = []
-    for i in range(len(all_labels)):
-        common_labels.append(1 if all_labels[i] in source_classes else 0)
-
     all_score_a = all_score_a.numpy()
     all_score_b = all_score_b.numpy()
     all_score_c = all_score_c.numpy()
-    common_labels = np.array(common_labels)
+    common_labels = class_membership(all_labels, source_classes).long().numpy()
 
     fpr_a, tpr_a, _ = roc_curve(common_labels, all_score_a)
     fpr_b, tpr_b, _ = roc_curve(common_labels, all_score_b)
@@ -480,63 +638,29 @@ def plot_roc(val_loader: DataLoader, model: ImageClassifier, esem, source_classe
 
 
 def cal_pr(scores, labels, thresholds):
-    new_scores = zip(scores.numpy(), labels)
-    new_scores = np.array(sorted(new_scores, key=lambda x: x[0], reverse=True))
-
-    points = []
-    for threshold in thresholds:
-        TP, FP, FN = 0, 0, 0
-        for score, label in new_scores:
-            if score >= threshold:
-                if label:
-                    TP += 1
-                else:
-                    FP += 1
-            else:
-                if label:
-                    FN += 1
-        points.append([TP / (TP + FN + 1e-7), TP / (TP + FP + 1e-7)])
+    curve = precision_recall(scores.numpy(), labels, thresholds)
+    points = np.stack([curve.recall, curve.precision], axis=1).tolist()
 
     print_points = [[0., 1.]] + sorted(points, key=lambda x: x[0]) + [[1., 0.]]
-    return list(zip(*print_points)), points
+    return list(zip(*print_points)), points, curve
 
 
-def plot_pr(val_loader: DataLoader, model: ImageClassifier, esem, source_classes: list, args: argparse.Namespace):
-    # switch to evaluate mode
-    model.eval()
-    esem.eval()
+def plot_pr(val_cache: EvaluationCache, source_classes: list, args: argparse.Namespace):
+    import pandas as pd
+    from matplotlib import pyplot as plt
 
-    all_confidence = list()
-    all_marginal_confidence = list()
-    all_entropy = list()
-    all_labels = list()
-
-    with torch.no_grad():
-        for i, (images, labels) in enumerate(val_loader):
-            images = images.to(device)
-
-            _, f = model(images)
-            yt_1, yt_2, yt_3, yt_4, yt_5 = esem(f)
-            confidence = get_confidence(yt_1, yt_2, yt_3, yt_4, yt_5)
-            marginal_confidence = get_marginal_confidence(yt_1, yt_2, yt_3, yt_4, yt_5)
-            entropy = get_entropy(yt_1, yt_2, yt_3, yt_4, yt_5)
-
-            all_confidence.extend(confidence)
-            all_marginal_confidence.extend(marginal_confidence)
-            all_entropy.extend(entropy)
-            all_labels.extend(labels)
-
-    all_confidence = norm(torch.tensor(all_confidence))
-    all_marginal_confidence = norm(torch.tensor(all_marginal_confidence))
-    all_entropy = norm(torch.tensor(all_entropy))
+    scores = val_cache.scores()
+    all_labels = scores.labels
+    all_confidence = norm(scores.confidence)
+    all_marginal_confidence = norm(scores.margin)
+    all_entropy = norm(scores.entropy)
     all_scores = [all_confidence, all_marginal_confidence, 1 - all_entropy,
                   (all_confidence + 1 - all_entropy) / 2,
                   (all_marginal_confidence + 1 - all_entropy) / 2,
                   (all_confidence + all_marginal_confidence) / 2,
                   (all_confidence + all_marginal_confidence + 1 - all_entropy) / 3]
 
-    common_labels = [(1 if label in source_classes else 0) for label in all_labels]
-    common_labels = np.array(common_labels)
+    common_labels = class_membership(all_labels, source_classes).long().numpy()
 
     step = 0.05
     source = args.source.split("/")[-1][:-4].capitalize()
@@ -548,12 +672,9 @@ def plot_pr(val_loader: DataLoader, model: ImageClassifier, esem, source_classes
     plt.plot([0, 1], [0, 1], 'm,-')
     results = []
     for i, scores in enumerate(all_scores):
-        results.append([])
-        (recall, precision), points = cal_pr(scores, common_labels, thresholds)
+        (recall, precision), points, curve = cal_pr(scores, common_labels, thresholds)
         plt.plot(recall, precision, label=names[i])
-        for j, point in enumerate(points):
-            recall, precision = point
-            results[-1].append((2 * recall * precision) / (recall + precision))
+        results.append(curve.f1)
     columns = []
     for threshold in thresholds:
         columns.append(f"T{threshold:.2f}")
@@ -565,54 +686,31 @@ def plot_pr(val_loader: DataLoader, model: ImageClassifier, esem, source_classes
     plt.savefig(f'ablation/PR-{source}->{target}.png')
 
 
-def evaluate_source_common(val_loader: DataLoader, model: ImageClassifier, esem, source_classes: list,
-                           args: argparse.Namespace):
+def evaluate_source_common(val_cache: EvaluationCache, source_classes: list, args: argparse.Namespace):
     temperature = 1
-    # switch to evaluate mode
-    model.eval()
-    esem.eval()
-
-    common = []
-    target_private = []
-
-    all_confidence = list()
-    all_entropy = list()
-    all_labels = list()
-    all_output = list()
 
-    source_weight = torch.zeros(len(source_classes)).to(device)
-    cnt = 0
+    outputs = val_cache.get()
+    scores = val_cache.scores()
+    local_scores = val_cache.scores(local=True)
     with torch.no_grad():
-        for i, (images, labels) in enumerate(val_loader):
-            images = images.to(device)
+        # the samples of this process are normalized with the range of the whole set
+        local_score = (norm(local_scores.margin, scores.margin) + 1 - norm(local_scores.entropy, scores.entropy)) / 2
 
-            output, f = model(images)
-            output = F.softmax(output, -1) / temperature
-            yt_1, yt_2, yt_3, yt_4, yt_5 = esem(f)
-            confidence = get_marginal_confidence(yt_1, yt_2, yt_3, yt_4, yt_5)
-            entropy = get_entropy(yt_1, yt_2, yt_3, yt_4, yt_5)
+        print('source_threshold = {}'.format(args.source_threshold))
 
-            all_confidence.extend(confidence)
-            all_entropy.extend(entropy)
-            all_labels.extend(labels)
+        # sum the predictions of confident samples with masked reductions on device, then over all processes;
+        # the softmax is taken chunk by chunk, so only O(chunk x classes) memory is added to the cached logits
+        selected = (local_score >= args.source_threshold).to(outputs.logits.dtype)
+        source_weight = outputs.logits.new_zeros(outputs.logits.size(1))
+        for logits, mask in zip(outputs.logits.split(args.eval_chunk_size), selected.split(args.eval_chunk_size)):
+            source_weight += mask @ (F.softmax(logits, -1) / temperature)
+        source_weight = all_reduce(source_weight)
+        cnt = all_reduce(selected.sum())
 
-            for each_output in output:
-                all_output.append(each_output)
-
-    all_confidence = norm(torch.tensor(all_confidence))
-    all_entropy = norm(torch.tensor(all_entropy))
-    all_score = (all_confidence + 1 - all_entropy) / 2
-
-    print('source_threshold = {}'.format(args.source_threshold))
-
-    for i in range(len(all_score)):
-        if all_score[i] >= args.source_threshold:
-            source_weight += all_output[i]
-            cnt += 1
-        if all_labels[i] in source_classes:
-            common.append(all_score[i])
-        else:
-            target_private.append(all_score[i])
+    all_score = (norm(scores.margin) + 1 - norm(scores.entropy)) / 2
+    is_common = class_membership(scores.labels, source_classes)
+    common = all_score[is_common].numpy()
+    target_private = all_score[~is_common].numpy()
 
     hist, bin_edges = np.histogram(common, bins=20, range=(0, 1))
     print(hist)
@@ -626,14 +724,53 @@ def evaluate_source_common(val_loader: DataLoader, model: ImageClassifier, esem,
     return source_weight
 
 
+def import_report(top: Optional[int] = 15):
+    """Prints the modules that take the longest to import when `main.py` starts"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, universal_newlines=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative), name.rstrip()))
+    # nested imports are indented below the top level ones
+    total = sum(cumulative for cumulative, name in modules if not name.startswith('  '))
+    print('total import time: {:.3f}s'.format(total / 1e6))
+    for cumulative, name in sorted(modules, reverse=True)[:top]:
+        print('{:10.3f}s  {}'.format(cumulative / 1e6, name.strip()))
+
+
 if __name__ == '__main__':
+    # the import report needs none of the required arguments, so it is handled before they are parsed
+    if '--import_report' in sys.argv[1:]:
+        import_report()
+        sys.exit()
+
     parser = argparse.ArgumentParser(description='PyTorch Domain Adaptation')
     parser.add_argument('root', help='root path of dataset')
     parser.add_argument('-d', '--data', default='Office31', help='dataset selected')
     parser.add_argument('-s', '--source', help='source domain(s)')
     parser.add_argument('-t', '--target', help='target domain(s)')
+    parser.add_argument('--source_shards', default=None, help='shard directory packed from the source list')
+    parser.add_argument('--target_shards', default=None, help='shard directory packed from the target list')
+    parser.add_argument('--val_cache_dir', default=None,
+                        help='cache the decoded validation images in a memory-mapped file in this directory')
+    parser.add_argument('--list_cache_dir', default=None,
+                        help='cache the parsed data lists in this directory, shared by the runs of a sweep')
     parser.add_argument('-a', '--arch', default='resnet50', help='backbone selected')
     parser.add_argument('-j', '--workers', default=4, type=int, help='number of data loading workers (default: 4)')
+    parser.add_argument('--pin_memory', action='store_true', help='load batches into pinned host memory')
+    parser.add_argument('--persistent_workers', action='store_true',
+                        help='keep data loading workers alive between passes over a dataset')
+    parser.add_argument('--prefetch_factor', default=2, type=int,
+                        help='batches loaded in advance by each worker (default: 2)')
+    parser.add_argument('--prefetch', default=0, type=int,
+                        help='training batches staged on the device ahead of use (default: 0)')
+    parser.add_argument('--batch_augment', action='store_true',
+                        help='produce the ensemble views with batched tensor augmentations on the training device '
+                             'instead of per image in the data loading workers')
     parser.add_argument('--pre_epochs', default=2, type=int, help='number of pretrain epochs to run')
     parser.add_argument('--epochs', default=20, type=int, help='number of total epochs to run')
     parser.add_argument('-b', '--batch_size', default=32, type=int, help='mini-batch size (default: 32)')
@@ -642,6 +779,10 @@ if __name__ == '__main__':
     parser.add_argument('--wd', '--weight_decay', default=1e-3, type=float, help='weight decay (default: 1e-3)',
                         dest='weight_decay')
     parser.add_argument('-p', '--print_freq', default=100, type=int, help='print frequency (default: 100)')
+    parser.add_argument('--dist_backend', default=None, choices=['gloo', 'nccl'],
+                        help='train data parallel over the processes started by torchrun, with this backend; '
+                             '-b is the batch size of each process')
+    parser.add_argument('--dist_url', default='env://', help='url of the process group rendezvous')
     parser.add_argument('--seed', default=None, type=int, help='seed for initializing training. ')
     parser.add_argument('--trade_off', default=1., type=float, help='the trade-off hyper-parameter for transfer loss')
     parser.add_argument('-i', '--iters_per_epoch', default=1000, type=int, help='Number of iterations per epoch')
@@ -650,6 +791,37 @@ if __name__ == '__main__':
     parser.add_argument('--n_total', default=31, type=int, help=" ")
     parser.add_argument('--threshold', default=0.6, type=float, help=" ")
     parser.add_argument('--source_threshold', default=0.9, type=float, help=" ")
+    parser.add_argument('--source_class_weight', default=None, type=str,
+                        help='text file with a fixed weight per source class, one per line '
+                             '(default: estimated from the target domain every epoch)')
+    parser.add_argument('--concat_forward', action='store_true',
+                        help='run source and target images through the classifier in one concatenated batch')
+    parser.add_argument('--domain_bn', action='store_true',
+                        help='with --concat_forward, normalize source and target with their own batch statistics')
+    parser.add_argument('--checkpoint', default=None, type=str,
+                        help='path of the training checkpoint, written in the background (default: no checkpoint)')
+    parser.add_argument('--checkpoint_freq', default=1, type=int, help='epochs between checkpoints (default: 1)')
+    parser.add_argument('--resume', default=None, type=str, help='checkpoint to resume training from')
+    parser.add_argument('--amp', action='store_true',
+                        help='train with automatic mixed precision')
+    parser.add_argument('--amp_dtype', default=None, choices=['float16', 'bfloat16'],
+                        help='reduced precision dtype used by --amp (default: float16 on GPU, bfloat16 on CPU)')
+    parser.add_argument('--esem_bank', default=0, type=int,
+                        help='number of augmented copies per source image in the precomputed feature bank '
+                             'used to train the ensemble (default: 0, train on images)')
+    parser.add_argument('--esem_bank_dir', default=None, type=str,
+                        help='directory of the memory-mapped feature bank (default: system temp dir)')
+    parser.add_argument('--eval_chunk_size', default=4096, type=int,
+                        help='evaluation samples whose softmax is materialized at once (default: 4096)')
+    parser.add_argument('--evaluate', action='store_true',
+                        help='only evaluate the models of --resume on the target set, without training')
+    parser.add_argument('--dump_scores', default=None, type=str,
+                        help='save per-sample predictions and uncertainty scores of the final evaluation '
+                             'to this .npz file, for threshold_sweep.py and infer.py --reference')
+    parser.add_argument('--import_report', action='store_true',
+                        help='print the slowest module imports of this script and exit')
     args = parser.parse_args()
+    if args.evaluate and args.resume is None:
+        parser.error('--evaluate needs the checkpoint to evaluate, pass --resume')
     print(args)
     main(args)
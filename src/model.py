@@ -4,11 +4,18 @@ from typing import List, Dict, Optional, Any, Tuple
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import Function
 from torch.hub import load_state_dict_from_url
 from torch.nn import Parameter
 from torchvision import models
-from torchvision.models.resnet import Bottleneck, model_urls
+from torchvision.models.resnet import Bottleneck
+
+try:
+    from torchvision.models.resnet import model_urls
+except ImportError:
+    # torchvision 0.13 removed the table, these are the ImageNet weights it pointed to
+    model_urls = {'resnet50': 'https://download.pytorch.org/models/resnet50-19c8e357.pth'}
 
 
 class ResNet(models.ResNet):
@@ -63,6 +70,52 @@ def resnet50(pretrained=False, progress=True, **kwargs):
                    **kwargs)
 
 
+class SplitBatchNorm(nn.modules.batchnorm._BatchNorm):
+    """Batch norm that, in training mode, normalizes each of `num_splits` equally sized chunks of the
+    batch with its own statistics, e.g. source and target images concatenated into one forward pass.
+    With `num_splits` = 1 or in evaluation mode it is a plain batch norm."""
+
+    def __init__(self, *args, num_splits: Optional[int] = 1, **kwargs):
+        super(SplitBatchNorm, self).__init__(*args, **kwargs)
+        self.num_splits = num_splits
+
+    def _check_input_dim(self, input):
+        if input.dim() not in (2, 3, 4):
+            raise ValueError('expected 2D, 3D or 4D input (got {}D input)'.format(input.dim()))
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        """"""
+        if self.training and self.num_splits > 1:
+            return torch.cat([super(SplitBatchNorm, self).forward(chunk)
+                              for chunk in input.chunk(self.num_splits, dim=0)], dim=0)
+        return super(SplitBatchNorm, self).forward(input)
+
+
+def convert_split_batchnorm(module: nn.Module) -> nn.Module:
+    """Replaces every batch norm layer of `module` with a :class:`SplitBatchNorm` sharing its parameters and
+    running statistics, so state dicts stay compatible"""
+    module_output = module
+    if isinstance(module, nn.modules.batchnorm._BatchNorm):
+        module_output = SplitBatchNorm(module.num_features, module.eps, module.momentum, module.affine,
+                                       module.track_running_stats)
+        if module.affine:
+            module_output.weight = module.weight
+            module_output.bias = module.bias
+        module_output.running_mean = module.running_mean
+        module_output.running_var = module.running_var
+        module_output.num_batches_tracked = module.num_batches_tracked
+    for name, child in module.named_children():
+        module_output.add_module(name, convert_split_batchnorm(child))
+    return module_output
+
+
+def set_batch_norm_splits(module: nn.Module, num_splits: int):
+    """Sets the number of chunks normalized separately by the :class:`SplitBatchNorm` layers of `module`"""
+    for m in module.modules():
+        if isinstance(m, SplitBatchNorm):
+            m.num_splits = num_splits
+
+
 class DomainDiscriminator(nn.Module):
 
     def __init__(self, in_feature: int, hidden_size: int):
@@ -88,6 +141,11 @@ class DomainDiscriminator(nn.Module):
 
 
 class GradientReverseFunction(Function):
+    """Identity in the forward pass, multiplies the gradient by `-coeff` in the backward pass.
+
+    The reversal is linear, so gradients scaled by a ``GradScaler`` stay correctly scaled and keep the
+    dtype of the (possibly reduced precision) input.
+    """
 
     @staticmethod
     def forward(ctx: Any, input: torch.Tensor, coeff: Optional[float] = 1.) -> torch.Tensor:
@@ -155,14 +213,21 @@ class DomainAdversarialLoss(nn.Module):
         self.domain_discriminator_accuracy = None
 
     def forward(self, f_s: torch.Tensor, f_t: torch.Tensor, w_s, w_t) -> torch.Tensor:
-        f = self.grl(torch.cat((f_s, f_t), dim=0))
-        d = self.domain_discriminator(f)
-        d_s, d_t = d.chunk(2, dim=0)
-        d_label_s = torch.ones((f_s.size(0), 1)).to(f_s.device)
-        d_label_t = torch.zeros((f_t.size(0), 1)).to(f_t.device)
-        self.domain_discriminator_accuracy = 0.5 * (binary_accuracy(d_s, d_label_s) + binary_accuracy(d_t, d_label_t))
-        source_loss = torch.mean(w_s * self.bce(d_s, d_label_s).view(-1))
-        target_loss = torch.mean(w_t * self.bce(d_t, d_label_t).view(-1))
+        return self.forward_concat(torch.cat((f_s, f_t), dim=0), w_s, w_t)
+
+    def forward_concat(self, f: torch.Tensor, w_s, w_t) -> torch.Tensor:
+        """Same as :meth:`forward`, with the source features followed by the target features in one tensor `f`,
+        e.g. the features of a single forward pass over both batches. The batch sizes are those of `w_s` and `w_t`."""
+        d = self.domain_discriminator(self.grl(f))
+        # binary cross entropy is not autocast-safe, so the loss is always computed in fp32
+        with torch.autocast(device_type=d.device.type, enabled=False):
+            d_s, d_t = d.float().split([w_s.size(0), w_t.size(0)], dim=0)
+            d_label_s = torch.ones((w_s.size(0), 1)).to(f.device)
+            d_label_t = torch.zeros((w_t.size(0), 1)).to(f.device)
+            self.domain_discriminator_accuracy = 0.5 * (binary_accuracy(d_s, d_label_s) +
+                                                        binary_accuracy(d_t, d_label_t))
+            source_loss = torch.mean(w_s * self.bce(d_s, d_label_s).view(-1))
+            target_loss = torch.mean(w_t * self.bce(d_t, d_label_t).view(-1))
         return 0.5 * (source_loss + target_loss)
 
 
@@ -222,49 +287,62 @@ class ImageClassifier(ClassifierBase):
 
 
 class Ensemble(nn.Module):
+    """Ensemble of linear classification heads sharing the same input features.
+
+    The weights of all members are stored as one stacked parameter so that the full ensemble
+    is evaluated with a single batched matmul and a single softmax.
 
-    def __init__(self, in_feature, num_classes):
+    Parameters:
+        - **in_feature** (int): Dimension of input features
+        - **num_classes** (int): Number of classes
+        - **num_members** (int, optional): Number of ensemble members. Default: 5
+
+    Shape:
+        - forward(x, index=k), k in [1, num_members]: :math:`(B, C)` logits of the k-th member
+        - forward(x): :math:`(K, B, C)` softmax probabilities of all members
+    """
+
+    def __init__(self, in_feature, num_classes, num_members=5):
         super(Ensemble, self).__init__()
-        self.fc1 = nn.Linear(in_feature, num_classes)
-        self.fc2 = nn.Linear(in_feature, num_classes)
-        self.fc3 = nn.Linear(in_feature, num_classes)
-        self.fc4 = nn.Linear(in_feature, num_classes)
-        self.fc5 = nn.Linear(in_feature, num_classes)
-        nn.init.xavier_uniform_(self.fc2.weight, gain=nn.init.calculate_gain('relu'))
-        nn.init.xavier_normal_(self.fc3.weight)
-        nn.init.kaiming_uniform_(self.fc4.weight, nonlinearity='relu')
-        nn.init.kaiming_normal_(self.fc5.weight)
+        self.num_members = num_members
+        self.weight = Parameter(torch.empty(num_members, num_classes, in_feature))
+        self.bias = Parameter(torch.empty(num_members, num_classes))
+        self.reset_parameters()
 
-    def forward(self, x, index=0):
-        if index == 1:
-            y = self.fc1(x)
-            # y = nn.Softmax(dim=-1)(y_1)
-        elif index == 2:
-            y = self.fc2(x)
-            # y = nn.Softmax(dim=-1)(y_2)
-        elif index == 3:
-            y = self.fc3(x)
-            # y = nn.Softmax(dim=-1)(y_3)
-        elif index == 4:
-            y = self.fc4(x)
-            # y = nn.Softmax(dim=-1)(y_4)
-        elif index == 5:
-            y = self.fc5(x)
-            # y = nn.Softmax(dim=-1)(y_5)
-        else:
-            y_1 = self.fc1(x)
-            y_1 = nn.Softmax(dim=-1)(y_1)
-            y_2 = self.fc2(x)
-            y_2 = nn.Softmax(dim=-1)(y_2)
-            y_3 = self.fc3(x)
-            y_3 = nn.Softmax(dim=-1)(y_3)
-            y_4 = self.fc4(x)
-            y_4 = nn.Softmax(dim=-1)(y_4)
-            y_5 = self.fc5(x)
-            y_5 = nn.Softmax(dim=-1)(y_5)
-            return y_1, y_2, y_3, y_4, y_5
+    def reset_parameters(self):
+        initializers = [
+            lambda w: nn.init.kaiming_uniform_(w, a=math.sqrt(5)),
+            lambda w: nn.init.xavier_uniform_(w, gain=nn.init.calculate_gain('relu')),
+            lambda w: nn.init.xavier_normal_(w),
+            lambda w: nn.init.kaiming_uniform_(w, nonlinearity='relu'),
+            lambda w: nn.init.kaiming_normal_(w),
+        ]
+        bound = 1. / math.sqrt(self.weight.size(2))
+        with torch.no_grad():
+            for k in range(self.num_members):
+                initializers[k % len(initializers)](self.weight[k])
+            self.bias.uniform_(-bound, bound)
 
-        return y
+    def forward(self, x, index=0):
+        if 1 <= index <= self.num_members:
+            return F.linear(x, self.weight[index - 1], self.bias[index - 1])
+
+        y = torch.baddbmm(self.bias.unsqueeze(1), x.unsqueeze(0).expand(self.num_members, -1, -1),
+                          self.weight.transpose(1, 2))
+        return F.softmax(y, dim=-1)
+
+    def member_logits(self, x):
+        """Logits of every member on its own features, :math:`(K, B, D)` to :math:`(K, B, C)`"""
+        return torch.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the heads were fused store one `fcK` linear layer per member
+        legacy_keys = [prefix + 'fc{}.weight'.format(k + 1) for k in range(self.num_members)]
+        if all(key in state_dict for key in legacy_keys):
+            state_dict[prefix + 'weight'] = torch.stack([state_dict.pop(key) for key in legacy_keys])
+            state_dict[prefix + 'bias'] = torch.stack(
+                [state_dict.pop(prefix + 'fc{}.bias'.format(k + 1)) for k in range(self.num_members)])
+        super(Ensemble, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def get_parameters(self) -> List[Dict]:
         """A parameter list which decides optimization hyper-parameters,
@@ -0,0 +1,127 @@
+import argparse
+import io
+import mmap
+import os
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+
+class ShardReader:
+    """Image loader reading encoded images from the shard files written by :func:`pack_data_list`.
+
+    It is a drop-in replacement for ``default_loader``: called with an image path of the data list,
+    it returns the RGB PIL image. Shards are memory-mapped lazily, so the reader can be sent
+    to data loading workers.
+
+    Parameters:
+        - **shard_dir** (str): Directory holding ``index.npz`` and the ``shard_*.bin`` files
+    """
+
+    def __init__(self, shard_dir: str):
+        self.shard_dir = shard_dir
+        index = np.load(os.path.join(shard_dir, 'index.npz'))
+        self.positions = {path: i for i, path in enumerate(index['paths'].tolist())}
+        self.shard = index['shard']
+        self.offset = index['offset']
+        self.length = index['length']
+        self._maps = {}
+
+    def __call__(self, path: str) -> Image.Image:
+        i = self.positions[path]
+        buffer = self._map(int(self.shard[i]))
+        start = int(self.offset[i])
+        data = buffer[start:start + int(self.length[i])]
+        with Image.open(io.BytesIO(data)) as img:
+            return img.convert('RGB')
+
+    def _map(self, shard: int) -> mmap.mmap:
+        if shard not in self._maps:
+            with open(os.path.join(self.shard_dir, shard_name(shard)), 'rb') as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+
+def shard_name(shard: int) -> str:
+    return 'shard_{:05d}.bin'.format(shard)
+
+
+def encode_image(path: str, resize: Optional[int] = None, quality: Optional[int] = 95) -> bytes:
+    """Returns the file content of `path`, or the JPEG re-encoded image with its shorter side resized to `resize`"""
+    if resize is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    with Image.open(path) as img:
+        img = img.convert('RGB')
+        w, h = img.size
+        scale = resize / min(w, h)
+        img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BILINEAR)
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=quality)
+    return out.getvalue()
+
+
+def pack_data_list(data_list_file: str, output_dir: str, root: Optional[str] = '',
+                   shard_size: Optional[int] = 1 << 30, resize: Optional[int] = None):
+    """Packs the images of a data list into a few large shard files with an offset index.
+
+    Parameters:
+        - **data_list_file** (str): Data list with one ``path class_index`` pair, or one ``path``, per line
+        - **output_dir** (str): Directory the shards and ``index.npz`` are written to
+        - **root** (str, optional): Root that relative paths are joined with, the same as the `root` of ``ImageList``
+        - **shard_size** (int, optional): Approximate size of each shard in bytes. Default: 1GB
+        - **resize** (int, optional): If given, images are stored resized to this shorter side
+    """
+    with open(data_list_file, "r") as f:
+        paths = []
+        for line in f.readlines():
+            if not line.strip():
+                continue
+            # the labels stay in the data list, lines of unlabeled lists only hold the path
+            path, *_ = line.split()
+            if not os.path.isabs(path):
+                path = os.path.join(root, path)
+            paths.append(path)
+    paths = list(dict.fromkeys(paths))
+
+    os.makedirs(output_dir, exist_ok=True)
+    shard = np.zeros(len(paths), dtype=np.int32)
+    offset = np.zeros(len(paths), dtype=np.int64)
+    length = np.zeros(len(paths), dtype=np.int64)
+
+    current, position = 0, 0
+    out = open(os.path.join(output_dir, shard_name(current)), 'wb')
+    for i, path in enumerate(paths):
+        data = encode_image(path, resize)
+        if position > 0 and position + len(data) > shard_size:
+            out.close()
+            current, position = current + 1, 0
+            out = open(os.path.join(output_dir, shard_name(current)), 'wb')
+        out.write(data)
+        shard[i], offset[i], length[i] = current, position, len(data)
+        position += len(data)
+        if i % 1000 == 0:
+            print('[{}/{}] {}'.format(i, len(paths), path))
+    out.close()
+
+    np.savez(os.path.join(output_dir, 'index.npz'), paths=np.array(paths), shard=shard, offset=offset,
+             length=length, resize=-1 if resize is None else resize)
+    print('packed {} images into {} shards in {}'.format(len(paths), current + 1, output_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the images of a data list into shard files')
+    parser.add_argument('data_list', help='data list file, e.g. data/domainnet/real_test.txt')
+    parser.add_argument('output_dir', help='directory the shards are written to')
+    parser.add_argument('--root', default='', help='root path of dataset, for data lists with relative paths')
+    parser.add_argument('--shard_size', default=1024, type=int, help='approximate shard size in MB (default: 1024)')
+    parser.add_argument('--resize', default=None, type=int,
+                        help='store images resized to this shorter side, e.g. 256 (default: original files)')
+    args = parser.parse_args()
+    pack_data_list(args.data_list, args.output_dir, args.root, args.shard_size << 20, args.resize)
@@ -0,0 +1,149 @@
+import argparse
+import csv
+import itertools
+import os
+import queue
+import re
+import subprocess
+import sys
+import threading
+import time
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+METRICS = {
+    'best_acc1': re.compile(r'best_acc1 = ([0-9.]+)'),
+    'test_acc1': re.compile(r'test_acc1 = ([0-9.]+)'),
+}
+COLUMNS = ['source', 'target', 'threshold', 'source_threshold', 'seed', 'status', 'attempts', 'slot',
+           'minutes', 'best_acc1', 'test_acc1', 'log']
+
+
+def build_runs(args: argparse.Namespace):
+    """One run per (domain pair, threshold, source threshold, seed) combination"""
+    runs = []
+    for pair, threshold, source_threshold, seed in itertools.product(args.pairs, args.thresholds,
+                                                                     args.source_thresholds, args.seeds):
+        source, target = pair.split(':')
+        name = '{}{}_{}_{}_{}_{}'.format(source[0], target[0], threshold, source_threshold, seed, args.comment)
+        command = [sys.executable, MAIN, args.root, '-d', args.data,
+                   '-s', os.path.join(args.list_dir, source + '.txt'),
+                   '-t', os.path.join(args.list_dir, target + '.txt'),
+                   '--threshold', str(threshold), '--source_threshold', str(source_threshold),
+                   '--seed', str(seed)] + args.main_args
+        runs.append({'source': source, 'target': target, 'threshold': threshold,
+                     'source_threshold': source_threshold, 'seed': seed, 'status': 'pending', 'attempts': 0,
+                     'log': os.path.join(args.log_dir, name + '.log'), 'command': command})
+    return runs
+
+
+def execute(run: dict, slot: str, slot_env: dict):
+    """Runs `main.py` for `run` in `slot`, writing its output to the run log, and records the parsed metrics"""
+    run['attempts'] += 1
+    run['slot'] = slot
+    begin = time.time()
+    with open(run['log'], 'w') as log:
+        returncode = subprocess.call(run['command'], stdout=log, stderr=subprocess.STDOUT,
+                                     env=dict(os.environ, **slot_env))
+    run['minutes'] = '{:.1f}'.format((time.time() - begin) / 60)
+
+    with open(run['log'], 'r') as log:
+        output = log.read()
+    for metric, pattern in METRICS.items():
+        found = pattern.findall(output)
+        run[metric] = found[-1] if found else ''
+    run['status'] = 'done' if returncode == 0 else 'failed ({})'.format(returncode)
+
+
+def worker(slot: str, slot_env: dict, pending: queue.Queue, remaining: list, args: argparse.Namespace,
+           lock: threading.Lock):
+    while True:
+        run = pending.get()
+        if run is None:
+            return
+        try:
+            execute(run, slot, slot_env)
+        except Exception as e:
+            # e.g. an unwritable log or a command that cannot be started; the run is retried like a failed one
+            run['status'] = 'failed (exception)'
+            with lock:
+                print('[{}] {}: {!r}'.format(slot, run['log'], e))
+        with lock:
+            print('[{}] {}->{} threshold={} source_threshold={} seed={}: {} after {} attempt(s), test_acc1={}'.format(
+                slot, run['source'], run['target'], run['threshold'], run['source_threshold'], run['seed'],
+                run['status'], run['attempts'], run.get('test_acc1', '')))
+            sys.stdout.flush()
+            # failed runs go back to the queue, to be picked up by whichever slot frees up first
+            if run['status'] != 'done' and run['attempts'] <= args.retries:
+                pending.put(run)
+            else:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    for _ in range(args.num_slots):
+                        pending.put(None)
+
+
+def write_results(runs, path: str):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for run in runs:
+            writer.writerow(run)
+
+
+def main(args: argparse.Namespace):
+    if args.devices:
+        slots = [('cuda:{}'.format(device), {'CUDA_VISIBLE_DEVICES': device})
+                 for device in args.devices for _ in range(args.runs_per_device)]
+    else:
+        slots = [('cpu:{}'.format(i), {'CUDA_VISIBLE_DEVICES': ''}) for i in range(args.cpu_slots)]
+
+    os.makedirs(args.log_dir, exist_ok=True)
+    runs = build_runs(args)
+    pending = queue.Queue()
+    for run in runs:
+        pending.put(run)
+    if not runs:
+        for _ in slots:
+            pending.put(None)
+    print('{} runs on {} slots'.format(len(runs), len(slots)))
+
+    args.num_slots = len(slots)
+    remaining = [len(runs)]
+    lock = threading.Lock()
+    threads = [threading.Thread(target=worker, args=(slot, slot_env, pending, remaining, args, lock))
+               for slot, slot_env in slots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results = args.results or os.path.join(args.log_dir, 'sweep_{}.csv'.format(args.comment))
+    write_results(runs, results)
+    print('results written to {}'.format(results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a grid of main.py experiments in parallel',
+                                     epilog='arguments after "--" are passed to every main.py run')
+    parser.add_argument('root', help='root path of dataset')
+    parser.add_argument('-d', '--data', default='Office31', help='dataset selected')
+    parser.add_argument('--list_dir', default='data/office', help='directory of the domain data lists')
+    parser.add_argument('--pairs', nargs='+', required=True,
+                        help='source:target domain pairs, named after the data lists, e.g. amazon:webcam')
+    parser.add_argument('--thresholds', nargs='+', default=[0.6], type=float, help='values of --threshold')
+    parser.add_argument('--source_thresholds', nargs='+', default=[0.85], type=float,
+                        help='values of --source_threshold')
+    parser.add_argument('--seeds', nargs='+', default=[2021], type=int, help='values of --seed')
+    parser.add_argument('--devices', nargs='*', default=[], help='GPU ids to schedule runs on')
+    parser.add_argument('--runs_per_device', default=1, type=int, help='concurrent runs per GPU (default: 1)')
+    parser.add_argument('--cpu_slots', default=1, type=int,
+                        help='concurrent CPU runs when no --devices are given (default: 1)')
+    parser.add_argument('--retries', default=1, type=int, help='times a failed run is retried (default: 1)')
+    parser.add_argument('--comment', default='sweep', help='tag added to log and result file names')
+    parser.add_argument('--log_dir', default='logs', help='directory of run logs')
+    parser.add_argument('--results', default=None, help='results table (default: <log_dir>/sweep_<comment>.csv)')
+    argv = sys.argv[1:]
+    main_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+    args.main_args = main_args
+    main(args)
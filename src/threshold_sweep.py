@@ -0,0 +1,53 @@
+import argparse
+import csv
+import os
+
+import numpy as np
+
+from lib import norm, threshold_sweep
+
+# the scores of `validate` and `plot_pr`, computed from the min-max normalized uncertainties
+SCORES = {
+    'margin+entropy': lambda s: (norm(s['margin']) + 1 - norm(s['entropy'])) / 2,
+    'conf+entropy': lambda s: (norm(s['confidence']) + 1 - norm(s['entropy'])) / 2,
+    'conf+margin+entropy': lambda s: (norm(s['confidence']) + norm(s['margin']) + 1 - norm(s['entropy'])) / 3,
+    'margin': lambda s: norm(s['margin']),
+    'conf': lambda s: norm(s['confidence']),
+    'entropy': lambda s: 1 - norm(s['entropy']),
+}
+
+
+def main(args: argparse.Namespace):
+    scores = np.load(args.scores)
+    score = SCORES[args.score](scores)
+    thresholds = np.round(np.arange(args.start, args.stop + args.step / 2, args.step), 6)
+    sweep = threshold_sweep(score, scores['prediction'], scores['label'], int(scores['num_source_classes']),
+                            thresholds)
+
+    output = args.output or os.path.splitext(args.scores)[0] + '_sweep.csv'
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['threshold', 'mean_accuracy', 'common_accuracy', 'unknown_accuracy', 'h_score'])
+        for row in zip(*sweep):
+            writer.writerow(['{:.4f}'.format(value) for value in row])
+    print('table written to {}'.format(output))
+
+    for name in ['mean_accuracy', 'h_score']:
+        values = getattr(sweep, name)
+        if np.all(np.isnan(values)):
+            continue
+        best = np.nanargmax(values)
+        print('best {} = {:.4f} at threshold {:.4f}'.format(name, values[best], thresholds[best]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate open-set accuracy over a grid of thresholds offline')
+    parser.add_argument('scores', help='scores file written by main.py --dump_scores')
+    parser.add_argument('--score', default='margin+entropy', choices=list(SCORES),
+                        help='score compared with the threshold (default: margin+entropy, as in validate)')
+    parser.add_argument('--start', default=0., type=float, help='first threshold (default: 0)')
+    parser.add_argument('--stop', default=1., type=float, help='last threshold (default: 1)')
+    parser.add_argument('--step', default=0.01, type=float, help='threshold step (default: 0.01)')
+    parser.add_argument('-o', '--output', default=None, help='table file (default: <scores>_sweep.csv)')
+    args = parser.parse_args()
+    main(args)
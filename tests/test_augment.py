@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.transforms import CenterCrop, Compose, FiveCrop, Lambda, Normalize, PILToTensor, ToTensor
+
+from augment import ESEM_VIEWS, MEAN, STD, BatchAugmenter, collate_padded
+
+# the deterministic part of `train_transform1` .. `train_transform5`: the crop each view keeps
+CROPS = {
+    'center': CenterCrop(224),
+    'top_left': Compose([FiveCrop(224), Lambda(lambda crops: crops[0])]),
+    'top_right': Compose([FiveCrop(224), Lambda(lambda crops: crops[1])]),
+    'bottom_left': Compose([FiveCrop(224), Lambda(lambda crops: crops[2])]),
+    'bottom_right': Compose([FiveCrop(224), Lambda(lambda crops: crops[3])]),
+}
+
+
+def random_images(sizes, seed=0):
+    rng = np.random.RandomState(seed)
+    return [Image.fromarray(rng.randint(0, 256, (h, w, 3), dtype=np.uint8)) for h, w in sizes]
+
+
+def padded_batch(images):
+    (batch, sizes), _ = collate_padded([(PILToTensor()(img), 0) for img in images])
+    return batch, sizes
+
+
+def test_crops_match_pil_transforms():
+    images = random_images([(256, 256), (256, 341), (300, 256)])
+    batch, sizes = padded_batch(images)
+    reference = Compose([ToTensor(), Normalize(MEAN, STD)])
+    for view in ESEM_VIEWS:
+        crop = view['crop']
+        out = BatchAugmenter(views=[dict(crop=crop)])(batch, sizes)[0]
+        for img, view_out in zip(images, out):
+            # the flip is random, so the view matches the crop of the image or of its mirror image
+            errors = [(view_out - reference(CROPS[crop](candidate))).abs().max().item()
+                      for candidate in (img, img.transpose(Image.FLIP_LEFT_RIGHT))]
+            assert min(errors) < 1e-3, crop
+
+
+def test_no_seam_at_padding():
+    # a uniform image smaller than the batch is padded with zeros; no warped pixel may blend them in
+    images = [Image.new('RGB', (256, 256), (200, 200, 200)), Image.new('RGB', (400, 300), (0, 0, 0))]
+    batch, sizes = padded_batch(images)
+    torch.manual_seed(0)
+    for _ in range(5):
+        out = BatchAugmenter(views=[dict(affine=(30, 0.2), crop='bottom_right')])(batch, sizes)[0][0]
+        pixels = out * torch.tensor(STD).view(3, 1, 1) + torch.tensor(MEAN).view(3, 1, 1)
+        # every pixel is either the image or the white fill of the affine warp
+        distance = torch.min((pixels - 200 / 255).abs(), (pixels - 1).abs())
+        assert distance.max().item() < 1e-4
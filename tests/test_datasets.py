@@ -0,0 +1,36 @@
+import os
+
+import datasets
+from datasets import load_data_list
+
+
+def test_list_cache_dir(tmp_path):
+    data_list_file = tmp_path / 'list.txt'
+    data_list_file.write_text('a/0.jpg 0\n\na/1.jpg 2\nb/2.jpg\n')
+    cache_dir = tmp_path / 'cache'
+
+    data_list = load_data_list(str(data_list_file), '/data', str(cache_dir))
+    expected = [('/data/a/0.jpg', 0), ('/data/a/1.jpg', 2), ('/data/b/2.jpg', -1)]
+    assert list(data_list) == expected
+    assert len(os.listdir(cache_dir)) == 1
+
+    # as in another process, the list is read back from the cache directory
+    datasets._data_lists.clear()
+    assert list(load_data_list(str(data_list_file), '/data', str(cache_dir))) == expected
+    assert list(load_data_list(str(data_list_file), '/data', str(cache_dir)).filter([2])) == expected[1:2]
+
+
+def test_multi_view_image_list_decodes_once(tmp_path):
+    data_list_file = tmp_path / 'list.txt'
+    data_list_file.write_text('0.jpg 1\n1.jpg 0\n')
+    dataset = datasets.MultiViewImageList(root=str(tmp_path), num_class=2, data_list_file=str(data_list_file),
+                                          filter_class=[0, 1], pre_transform=lambda img: img + '/resized',
+                                          view_transforms=[lambda img, k=k: '{}/view{}'.format(img, k)
+                                                           for k in range(5)])
+    loaded = []
+    dataset.loader = lambda path: loaded.append(path) or os.path.basename(path)
+
+    views, target = dataset[0]
+    assert loaded == [str(tmp_path / '0.jpg')]
+    assert views == ['0.jpg/resized/view{}'.format(k) for k in range(5)]
+    assert target == 1
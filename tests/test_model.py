@@ -0,0 +1,46 @@
+import torch
+import torch.nn.functional as F
+from torch.optim import SGD
+
+from lib import StepwiseLR
+from model import Ensemble
+
+
+def test_fused_ensemble_step_matches_separate_members():
+    # the ensemble heads of `train_esem` share one parameter and one optimizer step over the summed member
+    # losses; this must train every member exactly as its own optimizer and schedule would
+    torch.manual_seed(0)
+    num_members, num_classes, features_dim = 3, 4, 8
+    esem = Ensemble(features_dim, num_classes, num_members)
+    members = [Ensemble(features_dim, num_classes, 1) for _ in range(num_members)]
+    for k, member in enumerate(members):
+        member.load_state_dict({'weight': esem.weight.data[k:k + 1].clone(), 'bias': esem.bias.data[k:k + 1].clone()})
+
+    def sgd(model):
+        optimizer = SGD(model.get_parameters(), 0.1, momentum=0.9, weight_decay=1e-3, nesterov=True)
+        return optimizer, StepwiseLR(optimizer, init_lr=0.1, gamma=0.001, decay_rate=0.75)
+
+    optimizer, lr_scheduler = sgd(esem)
+    member_optimizers = [sgd(member) for member in members]
+
+    for _ in range(5):
+        f = torch.randn(num_members, 6, features_dim)
+        labels = torch.randint(num_classes, (6,))
+
+        lr_scheduler.step()
+        y = esem.member_logits(f)
+        loss = F.cross_entropy(y.flatten(0, 1), labels.repeat(num_members)) * num_members
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        for k, (member, (member_optimizer, member_scheduler)) in enumerate(zip(members, member_optimizers)):
+            member_scheduler.step()
+            member_loss = F.cross_entropy(member(f[k], 1), labels)
+            member_optimizer.zero_grad()
+            member_loss.backward()
+            member_optimizer.step()
+
+    for k, member in enumerate(members):
+        assert torch.allclose(esem.weight[k], member.weight[0], atol=1e-6)
+        assert torch.allclose(esem.bias[k], member.bias[0], atol=1e-6)
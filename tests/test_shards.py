@@ -0,0 +1,23 @@
+import numpy as np
+from PIL import Image
+
+from datasets import ImageList
+from shards import ShardReader, pack_data_list
+
+
+def test_pack_unlabeled_data_list(tmp_path):
+    rng = np.random.RandomState(0)
+    for name in ('0.png', '1.png'):
+        Image.fromarray(rng.randint(0, 256, (8, 6, 3), dtype=np.uint8)).save(tmp_path / name)
+    data_list_file = tmp_path / 'list.txt'
+    data_list_file.write_text('0.png\n\n1.png\n')
+
+    pack_data_list(str(data_list_file), str(tmp_path / 'shards'), root=str(tmp_path))
+
+    dataset = ImageList(root=str(tmp_path), num_class=1, data_list_file=str(data_list_file), filter_class=None,
+                        shard_dir=str(tmp_path / 'shards'))
+    assert len(dataset) == 2
+    assert isinstance(dataset.loader, ShardReader)
+    for (img, target), name in zip(dataset, ('0.png', '1.png')):
+        assert target == -1
+        assert np.array_equal(np.asarray(img), np.asarray(Image.open(tmp_path / name).convert('RGB')))